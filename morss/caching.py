@@ -15,7 +15,10 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with this program. If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
+import math
 import os
+import struct
 import threading
 import time
 from collections import OrderedDict
@@ -51,16 +54,136 @@ class BaseCache:
 
 
 class CappedDict(OrderedDict, BaseCache):
+    def __init__(self, *args, **kwargs):
+        self.lock = threading.RLock() # articles are fetched from several threads
+        self.size = kwargs.pop('size', None) # if set, trimmed on the fly
+        OrderedDict.__init__(self, *args, **kwargs)
+
     def trim(self):
-        if CACHE_SIZE >= 0:
-            for i in range( max( len(self) - CACHE_SIZE , 0 )):
-                self.popitem(False)
+        size = CACHE_SIZE if self.size is None else self.size
+
+        with self.lock:
+            if size >= 0:
+                for i in range( max( len(self) - size , 0 )):
+                    self.popitem(False)
 
     def __setitem__(self, key, data):
         # https://docs.python.org/2/library/collections.html#ordereddict-examples-and-recipes
-        if key in self:
-            del self[key]
-        OrderedDict.__setitem__(self, key, data)
+        with self.lock:
+            if key in self:
+                del self[key]
+            OrderedDict.__setitem__(self, key, data)
+
+            if self.size is not None:
+                self.trim()
+
+
+class BloomFilter:
+    """ Set-like, to remember lots of (str) items in little memory (about 10
+    bits per item for a 1% error rate). Can give false positives """
+
+    def __init__(self, capacity, error_rate=0.01, data=None):
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self.data = bytearray(data) if data is not None else bytearray((self.bits + 7) // 8)
+
+    def positions(self, item):
+        # double hashing, see Kirsch & Mitzenmacher
+        (h1, h2) = struct.unpack('<QQ', hashlib.md5(item.encode('utf-8')).digest())
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self.positions(item):
+            self.data[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.data[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(item))
+
+    def update(self, data):
+        " Adds the items of another filter (of the same size), given its `data` "
+        merged = int.from_bytes(bytes(self.data), 'little') | int.from_bytes(bytes(data), 'little')
+        self.data = bytearray(merged.to_bytes(len(self.data), 'little'))
+
+
+class AgingBloomFilter:
+    """ BloomFilter whose items are forgotten after `lifespan` sec (give or take
+    half of it), shared through the cache at `key` (synced every `sync_delay`
+    sec), so that all the processes using the same cache can use it """
+
+    def __init__(self, capacity, lifespan, cache=None, key=None, sync_delay=60):
+        self.capacity = capacity
+        self.period = max(lifespan // 2, 1)
+        self.cache = cache
+        self.key = key
+        self.sync_delay = sync_delay
+        self.lock = threading.RLock()
+        self.generations = {} # generation number -> BloomFilter
+        self.last_sync = None
+        self.dirty = False
+
+    def current(self):
+        return int(time.time() // self.period)
+
+    def live(self):
+        " Drops the expired generations, returns the live ones "
+
+        current = self.current()
+
+        for gen in [x for x in self.generations if x < current - 1]:
+            del self.generations[gen]
+
+        if current not in self.generations:
+            self.generations[current] = BloomFilter(self.capacity)
+
+        return self.generations
+
+    def add(self, item):
+        with self.lock:
+            self.live()[self.current()].add(item)
+            self.dirty = True
+
+        self.autosync()
+
+    def __contains__(self, item):
+        self.autosync()
+
+        with self.lock:
+            return any(item in bloom for bloom in self.live().values())
+
+    def autosync(self):
+        if self.cache is not None and (self.last_sync is None or time.time() - self.last_sync > self.sync_delay):
+            self.sync()
+
+    def sync(self):
+        " Merges with the copy in the cache (i.e. the other processes' items) "
+
+        with self.lock:
+            self.last_sync = time.time()
+
+            try:
+                raw = self.cache[self.key]
+
+            except KeyError:
+                raw = b''
+
+            # series of (generation number, data length, data)
+            i = 0
+            while i + 12 <= len(raw):
+                (gen, length) = struct.unpack('!qI', raw[i:i+12])
+                data = raw[i+12:i+12+length]
+                i += 12 + length
+
+                if gen >= self.current() - 1 and length == len(self.live()[self.current()].data):
+                    if gen in self.generations:
+                        self.generations[gen].update(data)
+
+                    else:
+                        self.generations[gen] = BloomFilter(self.capacity, data=data)
+
+            if self.dirty:
+                self.cache[self.key] = b''.join(struct.pack('!qI', gen, len(bloom.data)) + bytes(bloom.data)
+                    for (gen, bloom) in sorted(self.live().items()))
+                self.dirty = False
 
 
 try:
@@ -74,7 +197,12 @@ class RedisCacheHandler(BaseCache):
         self.r = redis.Redis(host=host, port=port, db=db, password=password)
 
     def __getitem__(self, key):
-        return self.r.get(key)
+        data = self.r.get(key)
+
+        if data is None:
+            raise KeyError(key)
+
+        return data
 
     def __setitem__(self, key, data):
         self.r.set(key, data)
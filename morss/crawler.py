@@ -15,38 +15,39 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with this program. If not, see <https://www.gnu.org/licenses/>.
 
+import functools
+import hashlib
+import heapq
+import itertools
+import json
 import os
 import pickle
 import random
 import re
+import socket
+import struct
 import sys
+import threading
 import time
 import zlib
 from cgi import parse_header
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from email import message_from_string
+from email.utils import mktime_tz, parsedate_tz
+from http.client import BadStatusLine, HTTPException, HTTPMessage, HTTPResponse
+from http.cookiejar import CookieJar
 from io import BytesIO, StringIO
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote, urljoin, urlsplit
+from urllib.request import (AbstractHTTPHandler, BaseHandler, HTTPHandler,
+                            HTTPRedirectHandler, HTTPSHandler, Request,
+                            addinfourl, build_opener, parse_http_list,
+                            parse_keqv_list)
 
 import chardet
 
-from .caching import default_cache
-
-try:
-    # python 2
-    from urllib import quote
-
-    from httplib import HTTPMessage
-    from urllib2 import (BaseHandler, HTTPCookieProcessor, HTTPRedirectHandler,
-                         Request, addinfourl, build_opener, parse_http_list,
-                         parse_keqv_list)
-    from urlparse import urlsplit
-except ImportError:
-    # python 3
-    from email import message_from_string
-    from http.client import HTTPMessage
-    from urllib.parse import quote, urlsplit
-    from urllib.request import (BaseHandler, HTTPCookieProcessor,
-                                HTTPRedirectHandler, Request, addinfourl,
-                                build_opener, parse_http_list, parse_keqv_list)
+from .caching import CappedDict, default_cache
 
 try:
     # python 2
@@ -82,37 +83,393 @@ DEFAULT_UAS = [
 PROTOCOL = ['http', 'https']
 
 
+RECORD = os.getenv('RECORD') # folder to save all the http exchanges into
+REPLAY = os.getenv('REPLAY') # folder to serve them from, instead of the network
+REPLAY_LATENCY = float(os.getenv('REPLAY_LATENCY', 0)) # replay at this share of the recorded response time
+
+POOL_SIZE = int(os.getenv('POOL_SIZE', 4)) # max idle connections kept per host
+POOL_IDLE = int(os.getenv('POOL_IDLE', 30)) # how long to keep idle connections (in sec)
+
+DNS_TTL = int(os.getenv('DNS_TTL', 5*60)) # how long to keep dns lookups (in sec)
+DNS_NEG_TTL = int(os.getenv('DNS_NEG_TTL', 30)) # same, for failed ones
+
+TIMEOUT_MIN = float(os.getenv('TIMEOUT_MIN', 1)) # adaptive timeouts lower bound (in sec)
+TIMEOUT_MAX = float(os.getenv('TIMEOUT_MAX', 10)) # adaptive timeouts upper bound (in sec)
+TIMEOUT_FACTOR = float(os.getenv('TIMEOUT_FACTOR', 3)) # adaptive timeouts, as a multiple of the usual response time
+
+REDIRECT_PERMANENT = int(os.getenv('REDIRECT_PERMANENT', 30*24*3600)) # how long to remember permanent redirects (in sec)
+REDIRECT_TEMPORARY = int(os.getenv('REDIRECT_TEMPORARY', 24*3600)) # same for temporary ones
+
+DISCOVERY_LIFESPAN = int(os.getenv('DISCOVERY_LIFESPAN', 7*24*3600)) # how long to remember which feed a page points to (in sec)
+
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 3)) # failed fetches in a row before leaving a host alone (0 to disable)
+BREAKER_DELAY = int(os.getenv('BREAKER_DELAY', 60)) # how long to leave it alone at first (in sec)
+
+FETCH_MAX = int(os.getenv('FETCH_MAX', 50)) # max number of fetches at once (0 for unlimited)
+FETCH_HOST_MAX = int(os.getenv('FETCH_HOST_MAX', 4)) # same, per host
+FETCH_HOST_DELAY = float(os.getenv('FETCH_HOST_DELAY', 0.1)) # min interval between 2 fetches to a host (in sec)
+
+STALE_WHILE_REVALIDATE = int(os.getenv('STALE_WHILE_REVALIDATE', 0)) # serve expired pages while refreshing them (in sec)
+STALE_IF_ERROR = int(os.getenv('STALE_IF_ERROR', 24*3600)) # serve expired pages when the server fails (in sec)
+
+HEDGE = float(os.getenv('HEDGE', 0)) # max extra fetches to send when a host is slower than usual (in %, 0 to disable)
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 95)) # response time (percentile of the host's usual ones) after which to send them
+
+
 def get(*args, **kwargs):
     return adv_get(*args, **kwargs)['data']
 
 
-def adv_get(url, post=None, timeout=None, *args, **kwargs):
+def adv_get(url, post=None, timeout=None, follow=None, policy=None, force_min=None, force_max=None, priority=1, accept=None, watcher=None, deadline=None):
+    # timeout: for hosts we don't know yet, then adapted (see LatencyTracker)
+    # priority: when the network is busy, lower values get fetched first
+    # accept: list of content-types, the body of the others is not downloaded
+    # watcher: class, to stop downloading pages early (see watch_response)
+    # deadline: time (as in time.time()) after which the page is of no use
+
     url = sanitize_url(url)
+    accept = tuple(accept) if accept else None
+    fetch = functools.partial(adv_fetch, post=post, timeout=timeout, follow=follow, policy=policy,
+        force_min=force_min, force_max=force_max, priority=priority, accept=accept, watcher=watcher, deadline=deadline)
 
     if post is not None:
-        post = post.encode('utf-8')
+        # might not be idempotent, don't share
+        return fetch(url)
+
+    if policy != 'refresh':
+        # known redirect/feed, skip the hops
+        page = default_redirects.get(url) or url
+        target = default_discovery.get(page, MIMETYPE[follow]) if follow else None
+        target = target or (page if page != url else None)
+
+        if target is not None:
+            try:
+                return adv_shared_fetch(target, fetch)
+
+            except HTTPError:
+                # might have changed since, go through the hops again (unless
+                # the error comes from the cache, i.e. says nothing of the server)
+                if policy not in ('offline', 'stale'):
+                    default_redirects.forget(url)
+                    default_discovery.forget(page)
+
+    return adv_shared_fetch(url, fetch)
+
+
+@functools.lru_cache()
+def resolve_opener():
+    # bare minimum to follow redirects (no cache since no body)
+    return build_opener(
+        CookieHandler(),
+        HTTPAllRedirectHandler(),
+        UAHandler(DEFAULT_UAS),
+        BrowserlyHeaderHandler(),
+        *transport_handlers()
+    )
+
+
+def resolve_url(url, timeout=None, offline=False):
+    """ Returns where `url` leads to (e.g. tracking links), following the http
+    redirects only, without downloading the page. Uses HEAD requests, or GET
+    requests cut short for the servers that don't like HEAD. Results go in the
+    redirect map, with `offline` only that map is used """
+
+    url = sanitize_url(url)
+    target = default_redirects.get(url)
+
+    if target is not None or offline:
+        return target or url
+
+    kwargs = {'timeout': timeout} if timeout is not None else {}
+
+    for method in ('HEAD', 'GET'):
+        req = Request(url, method=method)
+        req.redirects = []
 
-    if timeout is None:
-        con = custom_opener(*args, **kwargs).open(url, data=post)
+        try:
+            resp = resolve_opener().open(req, **kwargs)
+
+            if method == 'HEAD':
+                # no body, so that the connection can be reused
+                resp.read()
+
+            resp.close() # body not needed
+
+        except HTTPError as e:
+            if method == 'HEAD' and e.code in (403, 405, 501):
+                # HEAD not supported, try again with GET
+                continue
+
+            resp = e
+            resp.close()
+
+        except (IOError, HTTPException):
+            # no luck this time
+            return url
+
+        break
+
+    default_redirects.add(req.redirects, resp.geturl())
+
+    if not len(req.redirects) and 200 <= resp.code < 400:
+        # no redirect, to know next time too (unless the server is unwell)
+        default_redirects.set(url, url, True)
+
+    return resp.geturl()
+
+
+def adv_shared_fetch(url, fetch):
+    # same page being fetched by another thread? then wait for its result
+
+    key = (url,) + tuple(fetch.keywords.get(x) for x in ('follow', 'policy', 'force_min', 'force_max', 'accept', 'watcher'))
+    host = Request(url).host
+    hedged = functools.partial(default_hedger.do, host, functools.partial(fetch, url))
+
+    # don't wait for the other thread for longer than this call would have
+    timeout = fetch.keywords.get('timeout')
+    deadline = fetch.keywords.get('deadline')
+
+    if timeout is not None:
+        timeout = default_latency.timeout(host, timeout)
+
+    if deadline is not None:
+        left = max(0, deadline - time.time())
+        timeout = left if timeout is None else min(timeout, left)
+
+    (out, leader) = default_flights.do(key, hedged, timeout)
+
+    if leader:
+        return out
 
     else:
-        con = custom_opener(*args, **kwargs).open(url, data=post, timeout=timeout)
+        out = dict(out)
+        out['con'] = out['con'].copy() # with its own read position
+        return out
+
+
+def adv_fetch(url, post=None, timeout=None, follow=None, policy=None, force_min=None, force_max=None, priority=1, accept=None, watcher=None, deadline=None):
+    if post is not None:
+        post = post.encode('utf-8')
+
+    req = Request(url, data=post)
+    req.priority = priority # see FetchScheduler
+    req.watcher = watcher
+    req.redirects = [] # see HTTPAllRedirectHandler
+
+    if timeout is not None:
+        timeout = default_latency.timeout(req.host, timeout)
+
+    if deadline is not None:
+        if deadline <= time.time():
+            raise URLError('out of time')
+
+        left = deadline - time.time()
+
+        if timeout is None or left < timeout:
+            timeout = left
+            req.clamped = True # timeouts are then on us, not on the server (see KeepAliveMixin)
 
-    data = con.read()
+    kwargs = {'timeout': timeout} if timeout is not None else {}
+
+    try:
+        con = custom_opener(follow, policy, force_min, force_max, accept).open(req, **kwargs)
+
+    except HTTPError:
+        # the server did answer (and 5xx were already given a chance in CacheHandler)
+        raise
+
+    except (IOError, HTTPException) as e:
+        if post is not None or policy == 'offline':
+            raise
+
+        # server unreachable, try with a stale copy (if not too old, unless the
+        # server is known to be down for a while)
+        fallback = 'offline' if isinstance(e, CircuitOpen) else 'stale'
+
+        try:
+            req = Request(url)
+            req.watcher = watcher
+            con = custom_opener(follow, fallback, force_min, force_max, accept).open(req, **kwargs)
+
+        except (IOError, HTTPException):
+            pass
+
+        else:
+            return adv_result(con)
+
+        raise
+
+    if post is None and len(req.redirects):
+        default_redirects.add(req.redirects, con.geturl())
+
+    return adv_result(con)
+
+
+def adv_result(con):
+    con = buffer_response(con)
 
     contenttype = con.info().get('Content-Type', '').split(';')[0]
-    encoding= detect_encoding(data, con)
 
     return {
-        'data': data,
+        'data': con.data,
         'url': con.geturl(),
         'con': con,
         'contenttype': contenttype,
-        'encoding': encoding
+        'encoding': con.encoding # as detected by the handlers (if any)
     }
 
 
-def custom_opener(follow=None, policy=None, force_min=None, force_max=None):
+class InFlight:
+    " Single-flight: calls with the same `key` made meanwhile share the result "
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {} # key -> {'done': Event, 'result'/'error': ...}
+
+    def do(self, key, func, timeout=None):
+        """ Returns (result, True if `func` was run by this very call). Raises
+        URLError if another call's result isn't there within `timeout` sec """
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+
+            if leader:
+                call = self.calls[key] = {'done': threading.Event()}
+
+        if not leader:
+            if not call['done'].wait(timeout):
+                raise URLError('timed out waiting for a shared fetch')
+
+            if 'error' in call:
+                raise call['error']
+
+            return (call['result'], False)
+
+        try:
+            call['result'] = func()
+
+        except BaseException as e:
+            call['error'] = e
+            raise
+
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+            call['done'].set()
+
+        return (call['result'], True)
+
+
+default_flights = InFlight()
+
+
+class Hedger:
+    """ Tail latency: when `func` takes longer than (`percentile` of) the host's
+    usual response times, calls it a 2nd time and keeps whichever answers first.
+    The extra calls are kept within `percent` % of the calls that could have
+    been hedged and went online (i.e. not the cache hits) """
+
+    def __init__(self, percent=HEDGE, percentile=HEDGE_PERCENTILE, latency=None, burst=10):
+        self.percent = percent
+        self.percentile = percentile
+        self.latency = latency # LatencyTracker, defaults to `default_latency`
+        self.burst = burst # max number of saved-up extra calls
+        self.lock = threading.Lock()
+        self.budget = 0.
+        self.local = threading.local() # whether the call run by this thread went online
+
+    def went_online(self):
+        " To be called when sending a request to a server (see KeepAliveMixin) "
+        self.local.online = True
+
+    def earn(self):
+        with self.lock:
+            self.budget = min(self.budget + self.percent / 100., self.burst)
+
+    def spend(self):
+        with self.lock:
+            if self.budget >= 1:
+                self.budget -= 1
+                return True
+
+            return False
+
+    def do(self, host, func):
+        if self.percent <= 0:
+            return func()
+
+        delay = (self.latency or default_latency).percentile(host, self.percentile)
+
+        if delay is None:
+            # host not known enough yet
+            return func()
+
+        cond = threading.Condition()
+        results = [] # (ok, result or error), in order of arrival
+
+        def attempt(primary):
+            self.local.online = False
+
+            try:
+                out = (True, func())
+
+            except Exception as e:
+                out = (False, e)
+
+            if primary and self.local.online:
+                self.earn()
+
+            with cond:
+                results.append(out)
+                cond.notify()
+
+        def start(primary):
+            t = threading.Thread(target=attempt, args=(primary,))
+            t.daemon = True
+            t.start()
+
+        start(True)
+        attempts = 1
+
+        with cond:
+            cond.wait_for(lambda: results, delay)
+
+            if not results and self.spend():
+                start(False)
+                attempts += 1
+
+            # first success, or else the first error once they all failed
+            cond.wait_for(lambda: any(ok for (ok, out) in results) or len(results) == attempts)
+
+        for (ok, out) in results:
+            if ok:
+                return out
+
+        raise results[0][1]
+
+
+default_hedger = Hedger()
+
+
+def transport_handlers():
+    " The handlers getting the pages: from the network, or as per REPLAY/RECORD "
+
+    if REPLAY:
+        handlers = [HTTPReplayHandler(REPLAY, REPLAY_LATENCY), HTTPSReplayHandler(REPLAY, REPLAY_LATENCY)]
+
+    else:
+        handlers = [HTTPKeepAliveHandler(), HTTPSKeepAliveHandler()]
+
+    if RECORD:
+        handlers.append(RecordHandler(RECORD))
+
+    return handlers
+
+
+@functools.lru_cache()
+def custom_opener(follow=None, policy=None, force_min=None, force_max=None, accept=None):
     # as per urllib2 source code, these Handelers are added first
     # *unless* one of the custom handlers inherits from one of them
     #
@@ -129,23 +486,31 @@ def custom_opener(follow=None, policy=None, force_min=None, force_max=None):
     # During (3), if an http error occurs (i.e. not a 2XX response code), the
     # http_error_* are run until sth is returned (other than None). If they all
     # return nothing, a python error is raised
+    #
+    # openers are cached and shared by all the threads, so the handlers must
+    # not keep any per-request state (use attributes on `req` instead)
 
     handlers = [
         #DebugHandler(),
         SizeLimitHandler(500*1024), # 500KiB
-        HTTPCookieProcessor(),
+        CookieHandler(),
         GZIPHandler(),
         HTTPAllRedirectHandler(),
         HTTPEquivHandler(),
         HTTPRefreshHandler(),
-        UAHandler(random.choice(DEFAULT_UAS)),
+        UAHandler(DEFAULT_UAS),
         BrowserlyHeaderHandler(),
         EncodingFixHandler(),
     ]
 
+    handlers += transport_handlers()
+
     if follow:
         handlers.append(AlternateHandler(MIMETYPE[follow]))
 
+    if accept:
+        handlers.append(ContentTypeHandler(accept))
+
     handlers.append(CacheHandler(policy=policy, force_min=force_min, force_max=force_max))
 
     return build_opener(*handlers)
@@ -160,48 +525,855 @@ def is_ascii(string):
         return False
 
     else:
-        return True
+        return True
+
+
+def soft_quote(string):
+    " url-quote only when not a valid ascii string "
+
+    if is_ascii(string):
+        return string
+
+    else:
+        return quote(string.encode('utf-8'))
+
+
+def sanitize_url(url):
+    # make sure the url is unicode, i.e. not bytes
+    if isinstance(url, bytes):
+        url = url.decode('utf-8')
+
+    # make sure there's a protocol (http://)
+    if url.split(':', 1)[0] not in PROTOCOL:
+        url = 'http://' + url
+
+    # turns out some websites have really badly fomatted urls (fix http:/badurl)
+    url = re.sub('^(https?):/([^/])', r'\1://\2', url)
+
+    # escape spaces
+    url = url.replace(' ', '%20')
+
+    # escape non-ascii unicode characters
+    parts = urlsplit(url)
+
+    parts = parts._replace(
+        netloc=parts.netloc.replace(
+            parts.hostname,
+            parts.hostname.encode('idna').decode('ascii')
+            ),
+        path=soft_quote(parts.path),
+        query=soft_quote(parts.query),
+        fragment=soft_quote(parts.fragment),
+    )
+
+    return parts.geturl()
+
+
+class ConnectionPool:
+    " Idle keep-alive connections, shared by all the requests of the process "
+
+    def __init__(self, size=POOL_SIZE, idle=POOL_IDLE):
+        self.size = size
+        self.idle = idle
+        self.lock = threading.Lock()
+        self.conns = {} # key -> [(conn, last_used), ...], most recent last
+
+    def get(self, key):
+        " Returns an idle connection, or None "
+
+        with self.lock:
+            conns = self.conns.get(key, [])
+            now = time.time()
+
+            # drop the ones the server most likely closed by now
+            while len(conns) and now - conns[0][1] > self.idle:
+                conns.pop(0)[0].close()
+
+            if len(conns):
+                return conns.pop()[0]
+
+            self.conns.pop(key, None)
+            return None
+
+    def release(self, key, conn, reusable=True):
+        if not reusable or conn.sock is None or self.size <= 0:
+            # http.client drops the socket when the server asks to
+            conn.close()
+            return
+
+        with self.lock:
+            conns = self.conns.setdefault(key, [])
+            conns.append((conn, time.time()))
+
+            while len(conns) > self.size:
+                conns.pop(0)[0].close()
+
+
+default_pool = ConnectionPool()
+
+
+class FetchScheduler:
+    """ Process-wide limits on the number of fetches running at once (overall
+    and per host) and on how often a host is hit. Lowest `priority` goes first """
+
+    def __init__(self, total=FETCH_MAX, per_host=FETCH_HOST_MAX, delay=FETCH_HOST_DELAY):
+        self.total = total # 0 for unlimited
+        self.per_host = per_host # same
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.queue = [] # heap of waiting (priority, seq, host)
+        self.seq = itertools.count()
+        self.running = {} # host -> number of fetches running
+        self.last = {} # host -> time of the last fetch start
+
+    def host_wait(self, host, now):
+        " Returns how long `host` has to wait (in sec, None if unknown), or 0 "
+
+        if self.per_host > 0 and self.running.get(host, 0) >= self.per_host:
+            return None
+
+        return max(0, self.last.get(host, 0) + self.delay - now)
+
+    def wait_time(self, ticket):
+        now = time.time()
+
+        if self.total > 0 and sum(self.running.values()) >= self.total:
+            return None
+
+        for other in self.queue:
+            if other < ticket and self.host_wait(other[2], now) == 0:
+                # someone else is first in line
+                return None
+
+        return self.host_wait(ticket[2], now)
+
+    def acquire(self, host, priority=1, timeout=None):
+        ticket = (priority, next(self.seq), host)
+        deadline = time.time() + timeout if timeout is not None else None
+
+        with self.cond:
+            heapq.heappush(self.queue, ticket)
+
+            try:
+                while True:
+                    wait = self.wait_time(ticket)
+
+                    if wait == 0:
+                        break
+
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+
+                        if remaining <= 0:
+                            raise URLError('timed out waiting for a fetch slot')
+
+                        wait = remaining if wait is None else min(wait, remaining)
+
+                    self.cond.wait(wait)
+
+            finally:
+                self.queue.remove(ticket)
+                heapq.heapify(self.queue)
+                self.cond.notify_all()
+
+            self.running[host] = self.running.get(host, 0) + 1
+            self.last[host] = time.time()
+
+    def release(self, host):
+        with self.cond:
+            self.running[host] -= 1
+
+            if not self.running[host]:
+                del self.running[host]
+
+            # also forget about hosts not hit recently
+            now = time.time()
+            for key in [x for x in self.last if now - self.last[x] > self.delay and x not in self.running]:
+                del self.last[key]
+
+            self.cond.notify_all()
+
+
+default_scheduler = FetchScheduler()
+
+
+class LatencyTracker:
+    """ Keeps the last response times of each host, to give each its own
+    timeout: the usual (95th percentile) response time times `factor`, within
+    [`low`, `high`]. Hosts not seen enough yet get the default timeout """
+
+    def __init__(self, size=50, factor=TIMEOUT_FACTOR, low=TIMEOUT_MIN, high=TIMEOUT_MAX):
+        self.size = size
+        self.factor = factor
+        self.low = low
+        self.high = high
+        self.lock = threading.Lock()
+        self.hosts = CappedDict(size=1000) # host -> deque of response times (in sec)
+
+    def add(self, host, duration):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = deque(maxlen=self.size)
+
+            self.hosts[host].append(duration)
+
+    def percentile(self, host, percent):
+        with self.lock:
+            times = sorted(self.hosts.get(host, ()))
+
+        if len(times) < 5:
+            # not enough to tell
+            return None
+
+        return times[min(int(len(times) * percent / 100), len(times) - 1)]
+
+    def timeout(self, host, default):
+        p95 = self.percentile(host, 95)
+
+        if p95 is None:
+            return default
+
+        return min(max(p95 * self.factor, self.low), self.high)
+
+    def stats(self):
+        return dict((host, {
+            'count': len(self.hosts.get(host, ())),
+            'p50': self.percentile(host, 50),
+            'p95': self.percentile(host, 95),
+            'timeout': self.timeout(host, None),
+            }) for host in list(self.hosts.keys()))
+
+
+default_latency = LatencyTracker()
+
+
+class DNSCache:
+    " Hostname lookups, shared by all the requests of the process "
+
+    def __init__(self, ttl=DNS_TTL, neg_ttl=DNS_NEG_TTL, workers=4):
+        self.ttl = ttl
+        self.neg_ttl = neg_ttl
+        self.workers = workers # max number of lookups at once when prefetching
+        self.lock = threading.Lock()
+        self.entries = CappedDict(size=1000) # (host, port) -> (expiry, addrinfo list or error)
+        self.pending = set() # keys being prefetched
+        self.executor = None
+        self.hits = 0
+        self.misses = 0
+
+    def getaddrinfo(self, host, port):
+        key = (host, port)
+        entry = self.entries.get(key)
+
+        if entry is not None and entry[0] > time.time():
+            with self.lock:
+                self.hits += 1
+
+            if isinstance(entry[1], Exception):
+                raise entry[1]
+
+            return entry[1]
+
+        with self.lock:
+            self.misses += 1
+
+        try:
+            addrs = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+        except socket.gaierror as e:
+            self.entries[key] = (time.time() + self.neg_ttl, e)
+            raise
+
+        self.entries[key] = (time.time() + self.ttl, addrs)
+        return addrs
+
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        " Same as `socket.create_connection`, to be used as HTTPConnection._create_connection "
+
+        (host, port) = address
+        err = None
+
+        for (af, socktype, proto, canonname, sa) in self.getaddrinfo(host, port):
+            sock = None
+
+            try:
+                sock = socket.socket(af, socktype, proto)
+
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+
+                if source_address:
+                    sock.bind(source_address)
+
+                sock.connect(sa)
+                return sock
+
+            except OSError as e:
+                err = e
+
+                if sock is not None:
+                    sock.close()
+
+        # the host might have moved, look it up again next time
+        self.entries.pop((host, port), None)
+
+        if err is not None:
+            raise err
+
+        raise OSError('getaddrinfo returned an empty list')
+
+    def prefetch(self, urls):
+        " Looks up the urls' hosts in the background, to have them ready when needed "
+
+        keys = set()
+
+        for url in urls:
+            parts = urlsplit(url)
+
+            if parts.scheme in ('http', 'https') and parts.hostname:
+                try:
+                    keys.add((parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80)))
+
+                except ValueError:
+                    # invalid port
+                    pass
+
+        now = time.time()
+
+        for key in keys:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] <= now:
+                with self.lock:
+                    if key in self.pending:
+                        continue
+
+                    self.pending.add(key)
+
+                    if self.executor is None:
+                        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+                self.executor.submit(self.resolve, *key)
+
+    def resolve(self, host, port):
+        try:
+            self.getaddrinfo(host, port)
+
+        except OSError:
+            pass
+
+        finally:
+            with self.lock:
+                self.pending.discard((host, port))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+default_dns = DNSCache()
+
+
+class CircuitOpen(URLError):
+    " The host failed too often lately, and is left alone for a while "
+
+
+class CircuitBreaker:
+    """ Per-host health. After `failures` failed fetches in a row (or a single
+    one with a Retry-After header), fetches to the host fail straight away for
+    `delay` sec (doubled each time it happens again, or as per Retry-After).
+    Then one fetch is let through, and its outcome decides what's next """
+
+    def __init__(self, failures=BREAKER_FAILURES, delay=BREAKER_DELAY):
+        self.failures = failures
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.hosts = {} # host -> {'failures': int, 'trips': int, 'until': time, 'probe': time}
+
+    def check(self, host):
+        " Raises CircuitOpen if `host` is to be left alone "
+
+        with self.lock:
+            state = self.hosts.get(host)
+            now = time.time()
+
+            if state is None or state['until'] is None:
+                return
+
+            if now < state['until']:
+                raise CircuitOpen('%s is down, retrying in %is' % (host, state['until'] - now))
+
+            if state['probe'] is not None and now - state['probe'] < self.delay:
+                raise CircuitOpen('%s is down, retrying' % host)
+
+            # let this one through, as a probe
+            state['probe'] = now
+
+    def success(self, host):
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def failure(self, host, retry_after=None):
+        if self.failures <= 0:
+            # disabled
+            return
+
+        delay = parse_retry_after(retry_after)
+
+        with self.lock:
+            state = self.hosts.setdefault(host, {'failures': 0, 'trips': 0, 'until': None, 'probe': None})
+            state['failures'] += 1
+
+            if delay is None and (state['failures'] >= self.failures or state['probe'] is not None):
+                delay = min(self.delay * 2 ** state['trips'], 3600)
+
+            if delay is not None:
+                state['until'] = time.time() + delay
+                state['trips'] += 1
+                state['probe'] = None
+
+
+def parse_retry_after(value):
+    " Returns the Retry-After header value in seconds (capped to 1 day), or None "
+
+    if not value:
+        return None
+
+    value = value.strip()
+
+    if value.isdigit():
+        delay = int(value)
+
+    else:
+        date = parse_http_date(value)
+
+        if date is None:
+            return None
+
+        delay = date - time.time()
+
+    return min(max(delay, 0), 24*3600)
+
+
+def parse_http_date(value):
+    " Returns the timestamp of an http date (e.g. Expires header), or None "
+
+    date = parsedate_tz(value) if value else None
+
+    return mktime_tz(date) if date is not None else None
+
+
+default_breaker = CircuitBreaker()
+
+
+class PooledHTTPResponse(HTTPResponse):
+    " Hands the connection back (via `release`) once the body is fully read "
+
+    release = None
+
+    def _close_conn(self):
+        # called by http.client when reaching the end of the body
+        HTTPResponse._close_conn(self)
+        self._release(not self.will_close)
+
+    def close(self):
+        if self.fp is not None:
+            # unread data left, the connection can't be reused
+            self._release(False)
+
+        HTTPResponse.close(self)
+
+    def _release(self, reusable):
+        release, self.release = self.release, None
+
+        if release is not None:
+            release(reusable)
+
+
+class KeepAliveMixin:
+    " To be used with HTTPHandler/HTTPSHandler. Uses the `default_*` objects by default "
+
+    pool = None
+    scheduler = None
+    dns = None
+    breaker = None
+    latency_tracker = None
+    hedger = None
+
+    def do_open(self, http_class, req, **http_conn_args):
+        host = req.host
+        if not host:
+            raise URLError('no host given')
+
+        breaker = self.breaker or default_breaker
+        breaker.check(host)
+
+        scheduler = self.scheduler or default_scheduler
+        timeout = req.timeout if req.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT else socket.getdefaulttimeout()
+        scheduler.acquire(host, getattr(req, 'priority', 1), timeout)
+
+        latency = self.latency_tracker or default_latency
+        (self.hedger or default_hedger).went_online()
+        start = time.time()
+
+        try:
+            resp = self.do_pooled_open(http_class, req, **http_conn_args)
+
+        except:
+            err = sys.exc_info()[1]
+            timed_out = isinstance(getattr(err, 'reason', err), socket.timeout)
+
+            scheduler.release(host)
+
+            if timed_out and getattr(req, 'clamped', False):
+                # ran out of the caller's time (see adv_fetch), says nothing of the host
+                raise
+
+            if timed_out:
+                # so that slow hosts get more time next time
+                latency.add(host, time.time() - start)
+
+            breaker.failure(host)
+            raise
+
+        latency.add(host, time.time() - start)
+
+        if resp.status == 429 or resp.status >= 500:
+            breaker.failure(host, resp.headers.get('retry-after'))
+
+        else:
+            breaker.success(host)
+
+        if isinstance(resp, PooledHTTPResponse):
+            release = resp.release
+
+            def release_all(reusable):
+                scheduler.release(host)
+
+                if release is not None:
+                    release(reusable)
+
+            resp.release = release_all
+
+        else:
+            # no way to know when it's done, free the slot straight away
+            scheduler.release(host)
+
+        return resp
+
+    def do_pooled_open(self, http_class, req, **http_conn_args):
+        if req._tunnel_host:
+            # https via a proxy, let urllib handle it
+            return AbstractHTTPHandler.do_open(self, http_class, req, **http_conn_args)
+
+        host = req.host
+        pool = self.pool or default_pool
+        key = (http_class, host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        # NB. unlike urllib, no "Connection: close"
+
+        timeout = req.timeout if req.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT else socket.getdefaulttimeout()
+
+        while True:
+            conn = pool.get(key)
+            reused = conn is not None
+
+            if conn is None:
+                conn = http_class(host, timeout=req.timeout, **http_conn_args)
+                conn.response_class = PooledHTTPResponse
+                conn._create_connection = (self.dns or default_dns).create_connection
+
+            else:
+                conn.timeout = req.timeout
+                conn.sock.settimeout(timeout)
+
+            conn.set_debuglevel(self._debuglevel)
+            sent = False
+
+            try:
+                try:
+                    conn.request(req.get_method(), req.selector, req.data, headers,
+                        encode_chunked=req.has_header('Transfer-encoding'))
+
+                except OSError as err: # timeout error
+                    if reused and isinstance(err, ConnectionError):
+                        raise
+
+                    raise URLError(err)
+
+                sent = True
+                resp = conn.getresponse()
+
+            except (ConnectionError, BadStatusLine):
+                conn.close()
+
+                if reused and (not sent or req.data is None):
+                    # closed by the server in the meantime, try a fresh one
+                    # (unless a POST went through, as it might have been processed)
+                    continue
+
+                raise
+
+            except:
+                conn.close()
+                raise
+
+            break
+
+        resp.release = functools.partial(pool.release, key, conn)
+        resp.url = req.get_full_url()
+        resp.msg = resp.reason
+
+        return resp
+
+
+class HTTPKeepAliveHandler(KeepAliveMixin, HTTPHandler):
+    pass
+
+
+class HTTPSKeepAliveHandler(KeepAliveMixin, HTTPSHandler):
+    pass
+
+
+def exchange_path(folder, req):
+    " Where the exchange is saved, without the file extension "
+
+    key = req.get_method() + ' ' + req.get_full_url()
+
+    if req.data is not None:
+        key += ' ' + hashlib.sha1(req.data).hexdigest()
+
+    return os.path.join(folder, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+class RecordHandler(BaseHandler):
+    """ Saves the http exchanges into `folder`, as they come from the server
+    (see `curl -is`), along with the response time, for HTTPReplayHandler """
+
+    handler_order = 451 # right after SizeLimitHandler read the body
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def http_request(self, req):
+        req.record_start = time.time()
+        return req
+
+    def http_response(self, req, resp):
+        if getattr(req, 'from_morss_cache', False) or getattr(req, 'replayed', False):
+            return resp
+
+        resp = buffer_response(resp)
+        path = exchange_path(self.folder, req)
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+        with open(path + '.txt', 'wb') as f:
+            f.write(('HTTP/1.1 %s %s\r\n' % (resp.code, resp.msg)).encode('latin-1', 'replace'))
+
+            for (key, value) in resp.headers.items():
+                if key.lower() not in ('transfer-encoding', 'content-length'):
+                    # the body is saved as read, i.e. not chunked
+                    f.write(('%s: %s\r\n' % (key, value)).encode('latin-1', 'replace'))
+
+            f.write(b'\r\n')
+            f.write(resp.data)
+
+        with open(path + '.json', 'w') as f:
+            json.dump({
+                'method': req.get_method(),
+                'url': req.get_full_url(),
+                'time': time.time() - req.record_start
+                }, f)
+
+        return resp
+
+    https_request = http_request
+    https_response = http_response
+
+
+class ReplayMixin(KeepAliveMixin):
+    """ Serves the exchanges saved by RecordHandler, without touching the
+    network (404 for the others). To be used like KeepAliveMixin. With
+    `latency`, waits for that share of the recorded response time """
+
+    def __init__(self, folder, latency=0, *args, **kwargs):
+        super(ReplayMixin, self).__init__(*args, **kwargs)
+        self.folder = folder
+        self.latency = latency
+
+    def do_pooled_open(self, http_class, req, **http_conn_args):
+        req.replayed = True
+        path = exchange_path(self.folder, req)
+
+        if not os.path.isfile(path + '.txt'):
+            return error_response(404, 'Not Found', req.get_full_url())
+
+        if self.latency and os.path.isfile(path + '.json'):
+            with open(path + '.json') as f:
+                time.sleep(json.load(f)['time'] * self.latency)
+
+        with open(path + '.txt', 'rb') as f:
+            raw = f.read()
+
+        (head, _, body) = raw.partition(b'\r\n\r\n')
+        (status_line, _, headers) = head.decode('latin-1').partition('\r\n')
+        (version, code, msg) = (status_line.split(' ', 2) + [''])[:3]
+
+        return DataResponse(body, parse_headers(headers + '\r\n\r\n'), req.get_full_url(), int(code), msg)
+
+
+class HTTPReplayHandler(ReplayMixin, HTTPHandler):
+    pass
+
+
+class HTTPSReplayHandler(ReplayMixin, HTTPSHandler):
+    pass
+
+
+class DataResponse(addinfourl):
+    """ Response with the body read once and for all, to be shared by all the
+    handlers. To change the body, use `set_data` rather than a new response """
+
+    def __init__(self, data, headers, url, code, msg=None):
+        addinfourl.__init__(self, BytesIO(data), headers, url, code)
+        self.msg = msg
+        self.set_data(data)
+
+    def set_data(self, data, text=None, encoding=None):
+        " `text` and `encoding` to be provided if already known "
+        self.data = data
+        self.fp = BytesIO(data)
+        self._text = text
+        self._encoding = encoding
+
+    @property
+    def encoding(self):
+        # detected once, for all the handlers
+        if self._encoding is None:
+            self._encoding = detect_encoding(self.data, self)
+
+        return self._encoding
+
+    @property
+    def text(self):
+        # decoded once, for all the handlers
+        if self._text is None:
+            self._text = self.data.decode(self.encoding, 'replace')
+
+        return self._text
+
+    def copy(self):
+        " Same response, with its own read position "
+        resp = self.__class__.__new__(self.__class__)
+        resp.__dict__.update(self.__dict__) # copy.copy trips over addinfourl
+        resp.set_data(self.data, self._text, self._encoding)
+        return resp
+
+    # explicitly defined since addinfourl caches the methods of the first `fp`
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def readline(self, *args):
+        return self.fp.readline(*args)
+
+    def readlines(self, *args):
+        return self.fp.readlines(*args)
+
+    def __iter__(self):
+        return iter(self.fp)
+
+
+def buffer_response(resp, limit=None):
+    " Turns any response into a DataResponse, reading the body only if needed "
+
+    if isinstance(resp, DataResponse):
+        return resp
+
+    try:
+        data = resp.read() if limit is None else resp.read(limit)
+
+    finally:
+        # in case the limit was hit (or the read failed), frees the connection
+        resp.close()
+
+    return DataResponse(data, resp.headers, resp.url, resp.code, resp.msg)
+
+
+def watch_response(resp, watcher, limit=None, chunk_size=16*1024, unzip_limit=5*1024**2):
+    """ Same as buffer_response, but stops reading once `watcher.feed(data)`
+    (fed the body as it arrives) returns True. The response is then marked with
+    an 'X-Morss-Partial' header. The watcher is fed at most `unzip_limit` bytes
+    of decompressed data (same as GZIPHandler's default) """
+
+    if isinstance(resp, DataResponse):
+        return resp
+
+    encoding = resp.headers.get('Content-Encoding', 'identity').strip().lower()
+
+    if encoding in ('gzip', 'x-gzip'):
+        unzip = zlib.decompressobj(zlib.MAX_WBITS | 32)
+
+    elif encoding == 'deflate':
+        unzip = zlib.decompressobj()
+
+    elif encoding == 'identity':
+        unzip = None
+
+    else:
+        # can't make sense of it
+        return buffer_response(resp, limit)
 
+    chunks = []
+    size = 0
+    unzipped = 0
+    partial = False
 
-def soft_quote(string):
-    " url-quote only when not a valid ascii string "
+    try:
+        while limit is None or size < limit:
+            chunk = resp.read(chunk_size if limit is None else min(chunk_size, limit - size))
 
-    if is_ascii(string):
-        return string
+            if not chunk:
+                break
 
-    else:
-        return quote(string.encode('utf-8'))
+            chunks.append(chunk)
+            size += len(chunk)
 
+            if watcher is None:
+                continue
 
-def sanitize_url(url):
-    # make sure the url is unicode, i.e. not bytes
-    if isinstance(url, bytes):
-        url = url.decode('utf-8')
+            try:
+                data = chunk
 
-    # make sure there's a protocol (http://)
-    if url.split(':', 1)[0] not in PROTOCOL:
-        url = 'http://' + url
+                if unzip is not None:
+                    data = unzip.decompress(chunk, unzip_limit - unzipped if unzip_limit else 0)
+                    unzipped += len(data)
 
-    # turns out some websites have really badly fomatted urls (fix http:/badurl)
-    url = re.sub('^(https?):/([^/])', r'\1://\2', url)
+                if watcher.feed(data):
+                    partial = True
+                    break
 
-    # escape spaces
-    url = url.replace(' ', '%20')
+                if unzip_limit and unzipped >= unzip_limit:
+                    # GZIPHandler won't go any further either (zip bomb?)
+                    watcher = None
 
-    # escape non-ascii unicode characters
-    parts = urlsplit(url)
+            except zlib.error:
+                # just keep downloading, GZIPHandler will deal with it
+                watcher = None
 
-    parts = parts._replace(
-        netloc=parts.netloc.replace(
-            parts.hostname,
-            parts.hostname.encode('idna').decode('ascii')
-            ),
-        path=soft_quote(parts.path),
-        query=soft_quote(parts.query),
-        fragment=soft_quote(parts.fragment),
-    )
+    finally:
+        resp.close() # frees the connection (if all was read, or the read failed)
 
-    return parts.geturl()
+    out = DataResponse(b''.join(chunks), resp.headers, resp.url, resp.code, resp.msg)
+
+    if partial:
+        out.headers['X-Morss-Partial'] = '1'
+
+    return out
 
 
 class RespDataHandler(BaseHandler):
@@ -211,17 +1383,14 @@ class RespDataHandler(BaseHandler):
         pass
 
     def http_response(self, req, resp):
-        # read data
-        data = resp.read()
+        # read data (once for all the handlers)
+        resp = buffer_response(resp)
 
         # process data and use returned content (if any)
-        data = self.data_response(req, resp, data) or data
+        data = self.data_response(req, resp, resp.data)
 
-        # reformat the stuff
-        fp = BytesIO(data)
-        old_resp = resp
-        resp = addinfourl(fp, old_resp.headers, old_resp.url, old_resp.code)
-        resp.msg = old_resp.msg
+        if data:
+            resp.set_data(data)
 
         return resp
 
@@ -235,18 +1404,13 @@ class RespStrHandler(RespDataHandler):
         pass
 
     def data_response(self, req, resp, data):
-        #decode
-        enc = detect_encoding(data, resp)
-        data_str = data.decode(enc, 'replace')
-
-        #process
-        data_str = self.str_response(req, resp, data_str)
-
-        # return
-        data = data_str.encode(enc) if data_str is not None else data
+        # process (the decoded text is shared by all the handlers)
+        data_str = self.str_response(req, resp, resp.text)
 
-        #return
-        return data
+        # update
+        if data_str is not None:
+            enc = resp.encoding
+            resp.set_data(data_str.encode(enc), text=data_str, encoding=enc)
 
 
 class DebugHandler(BaseHandler):
@@ -273,34 +1437,81 @@ class SizeLimitHandler(BaseHandler):
         self.limit = limit
 
     def http_response(self, req, resp):
-        data = resp.read(self.limit)
-
-        fp = BytesIO(data)
-        old_resp = resp
-        resp = addinfourl(fp, old_resp.headers, old_resp.url, old_resp.code)
-        resp.msg = old_resp.msg
+        if getattr(req, 'watcher', None) is not None and 200 <= resp.code < 300:
+            return watch_response(resp, req.watcher(), self.limit)
 
-        return resp
+        return buffer_response(resp, self.limit)
 
     https_response = http_response
 
 
-def UnGzip(data):
-    " Supports truncated files "
-    return zlib.decompressobj(zlib.MAX_WBITS | 32).decompress(data)
+def UnGzip(data, limit=None):
+    " Supports truncated files. Stops after `limit` bytes of output, if set "
+    return zlib.decompressobj(zlib.MAX_WBITS | 32).decompress(data, limit or 0)
+
+
+def UnDeflate(data, limit=None):
+    " Same as UnGzip. Both zlib-wrapped and raw deflate are found in the wild "
+
+    try:
+        return zlib.decompressobj().decompress(data, limit or 0)
+
+    except zlib.error:
+        return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data, limit or 0)
 
 
 class GZIPHandler(RespDataHandler):
+    """ Decompresses gzip and deflate bodies, up to `limit` bytes (to be safe
+    from the so-called zip bombs), defaults to 5MiB """
+
+    def __init__(self, limit=5*1024**2):
+        self.limit = limit
+
     def http_request(self, req):
-        req.add_unredirected_header('Accept-Encoding', 'gzip')
+        req.add_unredirected_header('Accept-Encoding', 'gzip, deflate')
         return req
 
     def data_response(self, req, resp, data):
         if 200 <= resp.code < 300:
-            if resp.headers.get('Content-Encoding') == 'gzip':
+            encoding = resp.headers.get('Content-Encoding', '').strip().lower()
+
+            if encoding in ('gzip', 'x-gzip'):
+                del resp.headers['Content-Encoding']
+                resp.headers['Content-Encoding'] = 'identity'
+
+                return UnGzip(data, self.limit)
+
+            elif encoding == 'deflate':
+                del resp.headers['Content-Encoding']
                 resp.headers['Content-Encoding'] = 'identity'
 
-                return UnGzip(data)
+                return UnDeflate(data, self.limit)
+
+
+class ContentTypeHandler(BaseHandler):
+    """ Gives up on the responses whose Content-Type is not in `accept` (e.g.
+    pdf, images) right after the headers, without downloading the body """
+
+    handler_order = 440 # before SizeLimitHandler reads the body
+
+    def __init__(self, accept=None):
+        self.accept = accept or []
+
+    def http_response(self, req, resp):
+        contenttype = resp.headers.get('Content-Type', '').split(';')[0].strip().lower()
+
+        if (200 <= resp.code < 300 and len(self.accept) and contenttype
+                and contenttype not in self.accept and not isinstance(resp, DataResponse)):
+            # NB. DataResponse: already downloaded (e.g. from cache), keep it
+            resp.close()
+
+            out = DataResponse(b'', resp.headers, resp.url, resp.code, resp.msg)
+            out.aborted = True # not the real page, not to be cached
+            return out
+
+        return resp
+
+    https_response = http_response
 
 
 def detect_encoding(data, resp=None):
@@ -312,7 +1523,35 @@ def detect_encoding(data, resp=None):
     return enc
 
 
+charset_memo = CappedDict(size=1000) # host -> last charset detected
+
+
 def detect_raw_encoding(data, resp=None):
+    host = urlsplit(resp.url).hostname if getattr(resp, 'url', None) else None
+
+    enc = declared_encoding(data, resp)
+    if enc is not None:
+        if host:
+            charset_memo[host] = enc
+        return enc
+
+    # most websites stick to the same charset, so chardet as a last resort
+    enc = charset_memo.get(host) if host else None
+    if enc is not None:
+        return enc
+
+    enc = chardet.detect(data[-2000:])['encoding']
+    if enc and enc != 'ascii':
+        if host:
+            charset_memo[host] = enc
+        return enc
+
+    return 'utf-8'
+
+
+def declared_encoding(data, resp=None):
+    " Encoding from the http headers or the document itself, if any "
+
     if resp is not None:
         enc = resp.headers.get('charset')
         if enc is not None:
@@ -330,11 +1569,7 @@ def detect_raw_encoding(data, resp=None):
     if match:
         return match.groups()[0].lower().decode()
 
-    enc = chardet.detect(data[-2000:])['encoding']
-    if enc and enc != 'ascii':
-        return enc
-
-    return 'utf-8'
+    return None
 
 
 class EncodingFixHandler(RespStrHandler):
@@ -344,11 +1579,15 @@ class EncodingFixHandler(RespStrHandler):
 
 class UAHandler(BaseHandler):
     def __init__(self, useragent=None):
-        self.useragent = useragent
+        self.useragent = useragent # when a list, picks one for each request
 
     def http_request(self, req):
-        if self.useragent:
+        if isinstance(self.useragent, list):
+            req.add_unredirected_header('User-Agent', random.choice(self.useragent))
+
+        elif self.useragent:
             req.add_unredirected_header('User-Agent', self.useragent)
+
         return req
 
     https_request = http_request
@@ -397,6 +1636,9 @@ class AlternateHandler(RespStrHandler):
                     resp.code = 302
                     resp.msg = 'Moved Temporarily'
                     resp.headers['location'] = link.get('href')
+                    resp.synthetic = True # not a "real" redirect
+
+                    default_discovery.add(req.get_full_url(), urljoin(req.get_full_url(), link.get('href')), link.get('type'))
                     break
 
 
@@ -411,10 +1653,66 @@ class HTTPEquivHandler(RespStrHandler):
 
             for meta in iter_html_tag(data_str[:10000], 'meta'):
                 if 'http-equiv' in meta and 'content' in meta:
-                    resp.headers[meta.get('http-equiv').lower()] = meta.get('content')
+                    name = meta.get('http-equiv').lower()
+
+                    if name in ('content-type', 'charset'):
+                        if declared_encoding(b'', resp) is not None:
+                            # the http headers win, as in the browsers
+                            continue
+
+                        # replaced, or the server's header would still be used
+                        del resp.headers[name]
+                        resp.headers[name] = meta.get('content')
+
+                        # encoding to be detected again
+                        resp.set_data(resp.data)
+
+                    else:
+                        resp.headers[name] = meta.get('content')
+
+
+class CookieHandler(BaseHandler):
+    """ Like HTTPCookieProcessor, but the cookies are only kept for one fetch
+    (i.e. across its redirects), so that they don't leak to other requests """
+
+    handler_order = 700
+
+    def http_request(self, req):
+        if getattr(req, 'cookiejar', None) is None:
+            req.cookiejar = CookieJar()
+
+        req.cookiejar.add_cookie_header(req)
+        return req
+
+    def http_response(self, req, resp):
+        req.cookiejar.extract_cookies(resp, req)
+        return resp
+
+    https_request = http_request
+    https_response = http_response
 
 
 class HTTPAllRedirectHandler(HTTPRedirectHandler):
+    carry_over = ['cookiejar', 'priority', 'watcher', 'redirects', 'clamped'] # per-fetch attributes of `req` to keep
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new = HTTPRedirectHandler.redirect_request(self, req, fp, code, msg, headers, newurl)
+
+        if new is not None:
+            for attr in self.carry_over:
+                if hasattr(req, attr):
+                    setattr(new, attr, getattr(req, attr))
+
+            if hasattr(req, 'redirects'):
+                # the hops, for RedirectMap (list shared by all the hops)
+                req.redirects.append((req.get_full_url(), code, getattr(fp, 'synthetic', False)))
+
+            if req.get_method() == 'HEAD':
+                # see resolve_url
+                new.method = 'HEAD'
+
+        return new
+
     def http_error_308(self, req, fp, code, msg, headers):
         return self.http_error_301(req, fp, 301, msg, headers)
 
@@ -435,6 +1733,7 @@ class HTTPRefreshHandler(BaseHandler):
                         resp.code = 302
                         resp.msg = 'Moved Temporarily'
                         resp.headers['location'] = url
+                        resp.synthetic = True # not a "real" redirect
 
         return resp
 
@@ -451,11 +1750,141 @@ def parse_headers(text=u'\n\n'):
         return HTTPMessage(StringIO(text))
 
 
+def pack_headers(headers):
+    " Compact serialization of `headers` (much faster to load than to parse) "
+    return u'\0'.join(u'%s\0%s' % (key, value) for key, value in headers.items()).encode('utf-8')
+
+
+def unpack_headers(raw):
+    headers = HTTPMessage()
+
+    if len(raw):
+        items = raw.decode('utf-8').split(u'\0')
+
+        for key, value in zip(items[::2], items[1::2]):
+            headers[key] = value
+
+    return headers
+
+
 def error_response(code, msg, url=''):
     # return an error as a response
-    resp = addinfourl(BytesIO(), parse_headers(), url, code)
-    resp.msg = msg
-    return resp
+    return DataResponse(b'', parse_headers(), url, code, msg)
+
+
+class RedirectMap:
+    """ Where redirects lead to (skipping the intermediate hops), to go straight
+    there next time. Kept for `permanent` sec when all the hops are permanent
+    (301, 308), `temporary` sec otherwise """
+
+    def __init__(self, cache=None, permanent=REDIRECT_PERMANENT, temporary=REDIRECT_TEMPORARY):
+        self.cache = cache if cache is not None else default_cache
+        self.permanent = permanent
+        self.temporary = temporary
+
+    def get(self, url):
+        try:
+            entry = json.loads(self.cache['redirect:' + url].decode('utf-8'))
+
+        except (KeyError, ValueError):
+            return None
+
+        lifespan = self.permanent if entry['permanent'] else self.temporary
+
+        if time.time() - entry['timestamp'] > lifespan:
+            return None
+
+        return entry['url']
+
+    def forget(self, url):
+        self.cache['redirect:' + url] = b''
+
+    def add(self, hops, final):
+        " `hops`: list of (url, code, synthetic) as recorded by HTTPAllRedirectHandler "
+
+        target = final
+        permanent = True
+
+        for (url, code, synthetic) in reversed(hops):
+            if synthetic:
+                # the page itself points elsewhere (e.g. <link rel=alternate>)
+                # hence only the hops before it can be skipped
+                target = url
+                permanent = True
+                continue
+
+            permanent = permanent and code in (301, 308)
+
+            if url != target:
+                self.set(url, target, permanent)
+
+    def set(self, url, target, permanent):
+        self.cache['redirect:' + url] = json.dumps({'url': target, 'permanent': permanent, 'timestamp': time.time()}).encode('utf-8')
+
+
+default_redirects = RedirectMap()
+
+
+class DiscoveryIndex:
+    """ Which feed html pages point to (with <link rel='alternate' ... />), to
+    go straight to the feed next time. Kept for `lifespan` sec, after which
+    the page is checked again """
+
+    def __init__(self, cache=None, lifespan=DISCOVERY_LIFESPAN):
+        self.cache = cache if cache is not None else default_cache
+        self.lifespan = lifespan
+
+    def get(self, url, types):
+        " Returns the feed url, if the feed is of one of the mime `types` "
+
+        try:
+            entry = json.loads(self.cache['discovery:' + url].decode('utf-8'))
+
+        except (KeyError, ValueError):
+            return None
+
+        if time.time() - entry['timestamp'] > self.lifespan or entry['type'] not in types:
+            return None
+
+        return entry['url']
+
+    def forget(self, url):
+        self.cache['discovery:' + url] = b''
+
+    def add(self, url, feed, contenttype):
+        self.cache['discovery:' + url] = json.dumps({'url': feed, 'type': contenttype, 'timestamp': time.time()}).encode('utf-8')
+
+
+default_discovery = DiscoveryIndex()
+
+
+refreshing = set() # urls being refreshed in the background
+refreshing_lock = threading.Lock()
+
+
+CACHE_MAGIC = b'mrs\x02' # format version, to be bumped on changes
+CACHE_ENTRY = struct.Struct('!4sdHHII') # magic, timestamp, code, len(msg), len(headers), len(data)
+CACHE_ENTRY_V1 = struct.Struct('!4sdHHI') # same, with the data inline
+CACHE_BODY = 'body:' # prefix of the keys of the bodies, kept apart from the rest
+
+
+class CacheEntry(dict):
+    """ Cache entry, with its headers only unpacked when first needed, and its
+    body only loaded (with `load_data`) when first needed """
+
+    load_data = None
+
+    def __missing__(self, key):
+        if key == 'headers':
+            self['headers'] = unpack_headers(self.pop('packed_headers'))
+            return self['headers']
+
+        if key == 'data' and self.load_data is not None:
+            # KeyError if gone meanwhile
+            self['data'] = self.load_data()
+            return self['data']
+
+        raise KeyError(key)
 
 
 class CacheHandler(BaseHandler):
@@ -473,11 +1902,24 @@ class CacheHandler(BaseHandler):
                       # NB. This overrides all the other min/max/policy settings.
     handler_order = 499
 
+    stale_while_revalidate = STALE_WHILE_REVALIDATE # (in sec) how long after
+                        # its expiry a page can still be served, while it's
+                        # refreshed in the background
+    stale_if_error = STALE_IF_ERROR # (in sec) same, when the server fails. The
+                        # servers' own stale-* Cache-Control values are used if
+                        # longer, "must-revalidate" disables both.
+
+    heuristic_share = 0.1 # when servers don't say how long a page is valid
+                        # for, keep it for this share of the time since it
+                        # was last modified (as per RFC 9111)
+    heuristic_max = 24*3600 # (in sec) up to that, unless it's "immutable"
+    heuristic_codes = (200, 203, 204, 206, 300, 301, 308, 404, 405, 410, 414, 501)
+
     def __init__(self, cache=None, force_min=None, force_max=None, policy=None):
-        self.cache = cache or default_cache
+        self.cache = cache if cache is not None else default_cache
         self.force_min = force_min
         self.force_max = force_max
-        self.policy = policy # can be cached/refresh/offline/None (default)
+        self.policy = policy # can be cached/refresh/offline/stale/None (default)
 
         # Servers indicate how long they think their content is "valid". With
         # this parameter (force_min/max, expressed in seconds), we can override
@@ -489,6 +1931,8 @@ class CacheHandler(BaseHandler):
         #   offline: same as cached, i.e. use the cache no matter what, but do
         #            NOT fetch the page online if not present in cache, throw an
         #            error instead
+        #   stale: same as offline, but only if the cache is within the
+        #          stale-if-error period (used when the server is unreachable)
         #   None: just follow protocols
 
         # sanity checks
@@ -498,60 +1942,283 @@ class CacheHandler(BaseHandler):
 
     def load(self, url):
         try:
-            data = pickle.loads(self.cache[url])
+            raw = self.cache[url]
 
         except KeyError:
-            data = None
+            return None
+
+        if raw[:len(CACHE_MAGIC)] == CACHE_MAGIC:
+            magic, timestamp, code, len_msg, len_headers, size = CACHE_ENTRY.unpack_from(raw)
+            start = CACHE_ENTRY.size
+
+            entry = CacheEntry(
+                timestamp=timestamp,
+                code=code,
+                msg=raw[start:start+len_msg].decode('utf-8'),
+                packed_headers=raw[start+len_msg:start+len_msg+len_headers],
+                size=size,
+                )
+            entry.load_data = functools.partial(self.load_data, url, size)
+
+            return entry
+
+        # entry from an older version, migrate it
+
+        if raw[:len(CACHE_MAGIC)-1] == CACHE_MAGIC[:-1]:
+            # body inline
+            magic, timestamp, code, len_msg, len_headers = CACHE_ENTRY_V1.unpack_from(raw)
+            start = CACHE_ENTRY_V1.size
+
+            data = CacheEntry(
+                timestamp=timestamp,
+                code=code,
+                msg=raw[start:start+len_msg].decode('utf-8'),
+                packed_headers=raw[start+len_msg:start+len_msg+len_headers],
+                data=raw[start+len_msg+len_headers:],
+                )
 
         else:
+            # pickle
+            data = CacheEntry(pickle.loads(raw))
             data['headers'] = parse_headers(data['headers'] or unicode())
 
+        data['size'] = len(data['data'])
+        self.save(url, data)
+
+        return data
+
+    def load_data(self, url, size):
+        " Loads the body of the page (KeyError if gone, e.g. not the same page anymore) "
+
+        data = self.cache[CACHE_BODY + url]
+
+        if len(data) != size:
+            raise KeyError(url)
+
         return data
 
     def save(self, key, data):
-        data['headers'] = unicode(data['headers'])
-        self.cache[key] = pickle.dumps(data, 0)
+        " Saves the entry, and its body if provided (i.e. already loaded) "
+
+        if 'data' in data:
+            # body first, so that the metadata never points to a missing body
+            self.cache[CACHE_BODY + key] = data['data']
+            size = len(data['data'])
+
+        else:
+            size = data['size']
+
+        msg = (data['msg'] or u'').encode('utf-8')
+        headers = pack_headers(data['headers'])
+
+        self.cache[key] = b''.join([
+            CACHE_ENTRY.pack(CACHE_MAGIC, data['timestamp'], data['code'], len(msg), len(headers), size),
+            msg,
+            headers,
+            ])
+
+    def load_request(self, req):
+        " Same as `load`, but only hits the cache once for all the steps of `req` "
+
+        if not hasattr(req, 'cache_data'):
+            req.cache_data = self.load(req.get_full_url())
+
+            if (req.cache_data is not None and getattr(req, 'watcher', None) is None
+                    and 'x-morss-partial' in req.cache_data['headers']):
+                # truncated page (see watch_response), not good enough here
+                req.cache_data = None
+
+        return req.cache_data
 
     def cached_response(self, req, fallback=None):
         req.from_morss_cache = True
 
-        data = self.load(req.get_full_url())
+        data = self.load_request(req)
 
         if data is not None:
-            # return the cache as a response
-            resp = addinfourl(BytesIO(data['data']), data['headers'], req.get_full_url(), data['code'])
-            resp.msg = data['msg']
-            return resp
+            try:
+                # return the cache as a response
+                return DataResponse(data['data'], data['headers'], req.get_full_url(), data['code'], data['msg'])
 
-        else:
-            return fallback
+            except KeyError:
+                # body gone (e.g. trimmed from the cache)
+                if fallback is None:
+                    req.from_morss_cache = False # to save the page once fetched
+
+        return fallback
+
+    def refetch(self, req):
+        " Fetch the page again, without conditional request (i.e. in full) "
+
+        new_req = Request(req.get_full_url(), data=req.data, headers=req.headers)
+        new_req.cache_refresh = True # no cache
+        new_req.cache_data = None # no validators
+
+        for attr in HTTPAllRedirectHandler.carry_over:
+            if hasattr(req, attr):
+                setattr(new_req, attr, getattr(req, attr))
+
+        return self.parent.open(new_req, timeout=req.timeout)
 
     def save_response(self, req, resp):
         if req.from_morss_cache:
             # do not re-save (would reset the timing)
             return resp
 
-        data = resp.read()
+        resp = buffer_response(resp)
 
         self.save(req.get_full_url(), {
             'code': resp.code,
             'msg': resp.msg,
             'headers': resp.headers,
-            'data': data,
+            'data': resp.data,
             'timestamp': time.time()
             })
 
-        fp = BytesIO(data)
-        old_resp = resp
-        resp = addinfourl(fp, old_resp.headers, old_resp.url, old_resp.code)
-        resp.msg = old_resp.msg
-
         return resp
 
+    def freshen(self, req, resp):
+        " Update the cache entry after a '304 Not Modified', as if just fetched "
+
+        data = self.load_request(req)
+
+        for key in set(x.lower() for x in resp.headers.keys()) - set(['content-length']):
+            del data['headers'][key]
+
+            for value in resp.headers.get_all(key):
+                data['headers'][key] = value
+
+        data['timestamp'] = time.time()
+        self.save(req.get_full_url(), data)
+
+    def cache_control(self, data):
+        " Returns the Cache-Control (and Pragma) directives, as (list, dict of those with a value) "
+
+        cache_control = parse_http_list(data['headers'].get('cache-control', ()))
+        cache_control += parse_http_list(data['headers'].get('pragma', ()))
+
+        cc_list = [x for x in cache_control if '=' not in x]
+        cc_values = parse_keqv_list([x for x in cache_control if '=' in x])
+
+        return (cc_list, cc_values)
+
+    def age(self, data):
+        " How old the page is, including the time spent in caches upstream (RFC 9111 4.2.3) "
+
+        headers = data['headers']
+
+        date = parse_http_date(headers.get('date'))
+        apparent_age = max(data['timestamp'] - date, 0) if date is not None else 0
+
+        age = headers.get('age', '').strip()
+        age = int(age) if age.isdigit() else 0
+
+        return max(apparent_age, age) + time.time() - data['timestamp']
+
+    def lifetime(self, data):
+        " How long the page is valid for, as per the server (RFC 9111 4.2.1) "
+
+        headers = data['headers']
+        (cc_list, cc_values) = self.cache_control(data)
+
+        if 'no-cache' in cc_list:
+            # to be revalidated every time
+            return 0
+
+        if self.privacy == 'public' and cc_values.get('s-maxage', '').isdigit():
+            return int(cc_values['s-maxage'])
+
+        if cc_values.get('max-age', '').isdigit():
+            return int(cc_values['max-age'])
+
+        date = parse_http_date(headers.get('date')) or data['timestamp']
+
+        if 'expires' in headers:
+            expires = parse_http_date(headers.get('expires'))
+
+            # invalid dates (e.g. "0") mean "already expired"
+            return max(expires - date, 0) if expires is not None else 0
+
+        last_modified = parse_http_date(headers.get('last-modified'))
+
+        if last_modified is not None and data['code'] in self.heuristic_codes:
+            # nothing said, guess: pages that haven't changed for long are
+            # unlikely to change soon
+            lifetime = max(date - last_modified, 0) * self.heuristic_share
+
+            if 'immutable' in cc_list:
+                return lifetime
+
+            return min(lifetime, self.heuristic_max)
+
+        return 0
+
+    def allows_stale(self, data, directive, default):
+        " Whether the expired entry can be used, as per the stale-* `directive` "
+
+        (cc_list, cc_values) = self.cache_control(data)
+
+        if 'must-revalidate' in cc_list or 'no-cache' in cc_list or 'no-store' in cc_list:
+            return False
+
+        if self.privacy == 'public' and ('proxy-revalidate' in cc_list or 's-maxage' in cc_values):
+            return False
+
+        # how long the page was valid for
+        lifetime = self.lifetime(data)
+
+        if self.force_min is not None:
+            lifetime = max(lifetime, self.force_min)
+
+        if self.force_max is not None:
+            lifetime = min(lifetime, self.force_max)
+
+        window = int(cc_values[directive]) if cc_values.get(directive, '').isdigit() else 0
+        window = max(window, default)
+
+        return self.age(data) - lifetime < window
+
+    def refresh_in_background(self, req):
+        url = req.get_full_url()
+
+        with refreshing_lock:
+            if url in refreshing:
+                # already on it
+                return
+
+            refreshing.add(url)
+
+        def refresh():
+            try:
+                new_req = Request(url)
+                new_req.cache_refresh = True
+                self.parent.open(new_req, timeout=req.timeout).read()
+
+            except (IOError, HTTPException):
+                pass
+
+            finally:
+                with refreshing_lock:
+                    refreshing.discard(url)
+
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
+
+    def expired_response(self, req, data):
+        " The cache entry is too old: refresh, possibly serving it meanwhile "
+
+        if req.data is None and self.allows_stale(data, 'stale-while-revalidate', self.stale_while_revalidate):
+            self.refresh_in_background(req)
+            return self.cached_response(req)
+
+        else:
+            return None
+
     def http_request(self, req):
         req.from_morss_cache = False # to track whether it comes from cache
 
-        data = self.load(req.get_full_url())
+        data = self.load_request(req)
 
         if data is not None:
             if 'etag' in data['headers']:
@@ -571,15 +2238,11 @@ class CacheHandler(BaseHandler):
         # return 'resp'), or whether we want to refresh the content (return
         # 'None')
 
-        data = self.load(req.get_full_url())
+        data = self.load_request(req)
 
         if data is not None:
             # some info needed to process everything
-            cache_control = parse_http_list(data['headers'].get('cache-control', ()))
-            cache_control += parse_http_list(data['headers'].get('pragma', ()))
-
-            cc_list = [x for x in cache_control if '=' not in x]
-            cc_values = parse_keqv_list([x for x in cache_control if '=' in x])
+            (cc_list, cc_values) = self.cache_control(data)
 
             cache_age = time.time() - data['timestamp']
 
@@ -591,6 +2254,10 @@ class CacheHandler(BaseHandler):
             # (and doesn't need to be addressed anymore afterwards)
             return None
 
+        elif getattr(req, 'cache_refresh', False):
+            # background refresh (see stale-while-revalidate)
+            return None
+
         elif self.policy == 'offline':
             # use cache, or return an error
             return self.cached_response(
@@ -606,6 +2273,15 @@ class CacheHandler(BaseHandler):
             # force refresh
             return None
 
+        elif self.policy == 'stale':
+            # server unreachable, use cache if not too old, or return an error
+            if data is not None and self.allows_stale(data, 'stale-if-error', self.stale_if_error):
+                return self.cached_response(req)
+
+            else:
+                req.from_morss_cache = True # so as not to save the error
+                return error_response(409, 'Conflict', req.get_full_url())
+
         elif data is None:
             # we have already settled all the cases that don't need the cache.
             # all the following ones need the cached item
@@ -613,7 +2289,7 @@ class CacheHandler(BaseHandler):
 
         elif self.force_max is not None and cache_age > self.force_max:
             # older than we want, refresh
-            return None
+            return self.expired_response(req, data)
 
         elif self.force_min is not None and cache_age < self.force_min:
             # recent enough, use cache
@@ -625,7 +2301,7 @@ class CacheHandler(BaseHandler):
             # if you want to bypass this (needed for a proper refresh)
             return self.cached_response(req)
 
-        elif self.force_min is None and ('no-cache' in cc_list or 'no-store' in cc_list):
+        elif self.force_min is None and 'no-store' in cc_list:
             # kindly follow web servers indications, refresh if the same
             # settings are used all along, this section shouldn't be of any use,
             # since the page woudln't be cached in the first place the check is
@@ -633,31 +2309,41 @@ class CacheHandler(BaseHandler):
             # NB. NOT respected if force_min is set
             return None
 
-        elif 'max-age' in cc_values and int(cc_values['max-age']) > cache_age:
-            # server says it's still fine (and we trust him, if not, use overrides), use cache
+        elif self.age(data) < self.lifetime(data):
+            # server says it's still fine, through Cache-Control, Expires, or
+            # (when nothing is said) Last-Modified (and we trust him, if not,
+            # use overrides), use cache
             return self.cached_response(req)
 
         else:
-            # according to the www, we have to refresh when nothing is said
-            return None
+            # expired (or "no-cache"), refresh (conditional request, if possible)
+            return self.expired_response(req, data)
 
     def http_response(self, req, resp):
         # code for after-fetch, to know whether to save to hard-drive (if sticking to http headers' will)
 
-        if resp.code == 304 and resp.url in self.cache:
+        if resp.code == 304 and self.load_request(req) is not None:
             # we are hopefully the first after the HTTP handler, so no need
             # to re-run all the *_response
             # here: cached page, returning from cache
-            return self.cached_response(req)
+            self.freshen(req, resp)
+            return self.cached_response(req) or self.refetch(req)
 
-        elif self.force_min is None and ('cache-control' in resp.headers or 'pragma' in resp.headers):
-            cache_control = parse_http_list(resp.headers.get('cache-control', ()))
-            cache_control += parse_http_list(resp.headers.get('pragma', ()))
+        elif getattr(resp, 'aborted', False):
+            # body not downloaded (see ContentTypeHandler)
+            return resp
 
-            cc_list = [x for x in cache_control if '=' not in x]
+        elif resp.code in (500, 502, 503, 504) and self.load_request(req) is not None \
+                and self.allows_stale(self.load_request(req), 'stale-if-error', self.stale_if_error):
+            # server error, keep using the cache for a while
+            return self.cached_response(req, resp)
+
+        elif self.force_min is None and ('cache-control' in resp.headers or 'pragma' in resp.headers):
+            (cc_list, cc_values) = self.cache_control({'headers': resp.headers})
 
-            if 'no-cache' in cc_list or 'no-store' in cc_list or ('private' in cc_list and self.privacy == 'public'):
+            if 'no-store' in cc_list or ('private' in cc_list and self.privacy == 'public'):
                 # kindly follow web servers indications (do not save & return)
+                # NB. "no-cache" pages are saved, to be revalidated next time
                 return resp
 
             else:
@@ -15,12 +15,18 @@
 # You should have received a copy of the GNU Affero General Public License along
 # with this program. If not, see <https://www.gnu.org/licenses/>.
 
+import hashlib
+import json
 import os
 import re
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from fnmatch import fnmatch
+from http.client import HTTPException
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urljoin, urlparse
 
 import lxml.etree
 import lxml.html
@@ -28,16 +34,6 @@ from dateutil import tz
 
 from . import caching, crawler, feeds, readabilite
 
-try:
-    # python 2
-    from httplib import HTTPException
-    from urlparse import parse_qs, urljoin, urlparse
-except ImportError:
-    # python 3
-    from http.client import HTTPException
-    from urllib.parse import parse_qs, urljoin, urlparse
-
-
 MAX_ITEM = int(os.getenv('MAX_ITEM', 5)) # cache-only beyond
 MAX_TIME = int(os.getenv('MAX_TIME', 2)) # cache-only after (in sec)
 
@@ -45,13 +41,23 @@ LIM_ITEM = int(os.getenv('LIM_ITEM', 10)) # deletes what's beyond
 LIM_TIME = int(os.getenv('LIM_TIME', 2.5)) # deletes what's after
 
 DELAY = int(os.getenv('DELAY', 10 * 60)) # xml cache & ETag cache (in sec)
+REFRESH_MIN = int(os.getenv('REFRESH_MIN', 5 * 60)) # min time before checking a feed again (in sec)
+REFRESH_MAX = int(os.getenv('REFRESH_MAX', 60 * 60)) # max time before checking a feed again (in sec)
 TIMEOUT = int(os.getenv('TIMEOUT', 4)) # http timeout (in sec)
+THREADS = int(os.getenv('THREADS', 10)) # number of articles fetched at once
+UNUSABLE_SIZE = int(os.getenv('UNUSABLE_SIZE', 1000000)) # number of unusable links to remember
+UNUSABLE_DELAY = int(os.getenv('UNUSABLE_DELAY', 7 * 24 * 3600)) # for how long (in sec)
+EARLY_STOP = int(os.getenv('EARLY_STOP', 0)) # stop downloading articles once their main text is in
 
 
 class MorssException(Exception):
     pass
 
 
+# links that don't lead to an article (4xx, pdf, no article found, etc.)
+unusable_links = caching.AgingBloomFilter(UNUSABLE_SIZE, UNUSABLE_DELAY, caching.default_cache, 'unusable-links')
+
+
 def log(txt):
     if 'DEBUG' in os.environ:
         if 'REQUEST_URI' in os.environ:
@@ -192,7 +198,24 @@ def ItemFill(item, options, feedurl='/', fast=False):
         log('no link')
         return True
 
-    log(item.link)
+    return ItemUpdate(item, options, ItemFetch(item.link, options, fast))
+
+
+def ItemFetch(link, options, fast=False, deadline=None):
+    """ Downloads and extracts the article, without touching the feed item (so
+    that it can run in a separate thread). Returns None on http error, or when
+    not done by `deadline` (time.time()-like) """
+
+    log(link)
+
+    # known to be a dead end?
+
+    link = crawler.sanitize_url(link)
+    check = not options.xpath # custom xpath, might find something after all
+
+    if check and not options.force and link in unusable_links:
+        log('unusable link')
+        return {'content': None, 'url': None}
 
     # download
 
@@ -207,28 +230,69 @@ def ItemFill(item, options, feedurl='/', fast=False):
     else:
         policy = None
 
+    if EARLY_STOP and not options.xpath:
+        # no telling where the custom xpath points to, so full page otherwise
+        watcher = readabilite.ArticleWatcher
+
+    else:
+        watcher = None
+
     try:
-        req = crawler.adv_get(url=item.link, policy=policy, force_min=24*60*60, timeout=TIMEOUT)
+        req = crawler.adv_get(url=link, policy=policy, force_min=24*60*60, timeout=TIMEOUT, accept=crawler.MIMETYPE['html'] + ['text/plain'], watcher=watcher, deadline=deadline)
 
     except (IOError, HTTPException) as e:
         log('http error')
-        return False # let's just delete errors stuff when in cache mode
+
+        if check and policy != 'offline' and isinstance(e, HTTPError) and 400 <= e.code < 500 and e.code not in (408, 409, 429):
+            # i.e. not temporary
+            unusable_links.add(link)
+
+        return None
 
     if req['contenttype'] not in crawler.MIMETYPE['html'] and req['contenttype'] != 'text/plain':
         log('non-text page')
-        return True
+
+        if check:
+            unusable_links.add(link)
+
+        return {'content': None, 'url': None}
 
     if not req['data']:
         log('empty page')
-        return True
+
+        if check and policy != 'offline':
+            unusable_links.add(link)
+
+        return {'content': None, 'url': None}
 
     out = readabilite.get_article(req['data'], url=req['url'], encoding_in=req['encoding'], encoding_out='unicode', xpath=options.xpath)
 
-    if out is not None:
-        item.content = out
+    if out is None and check:
+        unusable_links.add(link)
+
+    return {'content': out, 'url': req['url']}
+
+
+def ItemResolve(link, options, fast=False):
+    """ Same as ItemFetch, but only to find out where the link leads to (e.g.
+    tracking links), without downloading the article """
 
-    if options.resolve:
-        item.link = req['url']
+    log(link)
+
+    return {'content': None, 'url': crawler.resolve_url(link, timeout=TIMEOUT, offline=(fast or options.cache))}
+
+
+def ItemUpdate(item, options, fetched):
+    """ Applies the output of ItemFetch to the item, returns like ItemFill """
+
+    if fetched is None:
+        return False # let's just delete errors stuff when in cache mode
+
+    if fetched['content'] is not None:
+        item.content = fetched['content']
+
+    if options.resolve and fetched['url'] is not None:
+        item.link = fetched['url']
 
     return True
 
@@ -262,6 +326,60 @@ def ItemAfter(item, options):
     return item
 
 
+def FeedHistory(url):
+    " Returns what we know of the feed's past updates (item ids, update times) "
+
+    try:
+        return json.loads(caching.default_cache['history:' + url].decode('utf-8'))
+
+    except (KeyError, ValueError):
+        return None
+
+
+def FeedRefresh(url):
+    """ Returns the (force_min, force_max) to use for the feed, i.e. for how
+    long to trust the cached copy, based on how often the feed gets updated """
+
+    history = FeedHistory(url)
+
+    if history is None or len(history['updates']) < 2:
+        # no idea yet, stick to the http headers
+        return (REFRESH_MIN, REFRESH_MAX)
+
+    updates = history['updates']
+    gaps = sorted(b - a for (a, b) in zip(updates, updates[1:]))
+    gap = gaps[len(gaps) // 2]
+
+    # gone quiet lately?
+    gap = max(gap, time.time() - updates[-1])
+
+    # checking twice per update on average
+    window = min(max(gap / 2, REFRESH_MIN), REFRESH_MAX)
+
+    return (int(window), int(window))
+
+
+def FeedTrack(url, rss):
+    " Records the feed's updates (i.e. new items), for FeedRefresh "
+
+    ids = [hashlib.md5((item.link or item.title or '').encode('utf-8')).hexdigest()[:12] for item in rss.items]
+    history = FeedHistory(url)
+
+    if history is None:
+        # first time, guess from the items' dates
+        dates = [item.updated or item.time for item in rss.items]
+        updates = sorted(x.timestamp() for x in dates if x is not None)
+
+    elif len(set(ids) - set(history['ids'])):
+        updates = history['updates'] + [time.time()]
+
+    else:
+        # nothing new
+        return
+
+    caching.default_cache['history:' + url] = json.dumps({'ids': ids, 'updates': updates[-10:]}).encode('utf-8')
+
+
 def FeedFetch(url, options):
     # fetch feed
     delay = DELAY
@@ -275,8 +393,10 @@ def FeedFetch(url, options):
     else:
         policy = None
 
+    (force_min, force_max) = FeedRefresh(url)
+
     try:
-        req = crawler.adv_get(url=url, post=options.post, follow=('rss' if not options.items else None), policy=policy, force_min=5*60, force_max=60*60, timeout=TIMEOUT)
+        req = crawler.adv_get(url=url, post=options.post, follow=('rss' if not options.items else None), policy=policy, force_min=force_min, force_max=force_max, timeout=TIMEOUT, priority=0)
 
     except (IOError, HTTPException):
         raise MorssException('Error downloading feed')
@@ -316,9 +436,39 @@ def FeedFetch(url, options):
             log(req['contenttype'])
             raise MorssException('Link provided is not a valid feed')
 
+    if not options.post:
+        FeedTrack(url, rss)
+
+    if not options.proxy and not options.cache and not crawler.REPLAY:
+        # get the hosts of the articles FeedGather will fetch ready (the others
+        # are cache-only or deleted)
+        limits = [x for x in (MAX_ITEM, LIM_ITEM) if x >= 0]
+        items = FeedSort(rss, options)[:min(limits) if limits else None]
+        crawler.default_dns.prefetch(urljoin(req['url'], item.link) for item in items if item.link)
+
     return req['url'], rss
 
 
+def FeedSort(rss, options):
+    " Returns the items in the order they are to be filled in "
+
+    sorted_items = list(rss.items)
+
+    if options.order == 'last':
+    # `first` does nothing from a practical standpoint, so only `last` needs
+    # to be addressed
+        sorted_items = reversed(sorted_items)
+
+    elif options.order in ['newest', 'oldest']:
+        now = datetime.now(tz.tzutc())
+        sorted_items = sorted(sorted_items, key=lambda x:x.updated or x.time or now) # oldest to newest
+
+        if options.order == 'newest':
+            sorted_items = reversed(sorted_items)
+
+    return list(sorted_items)
+
+
 def FeedGather(rss, url, options):
     size = len(rss.items)
     start_time = time.time()
@@ -333,46 +483,66 @@ def FeedGather(rss, url, options):
         max_time = 0
 
     # sort
-    sorted_items = list(rss.items)
+    sorted_items = FeedSort(rss, options)
 
-    if options.order == 'last':
-    # `first` does nothing from a practical standpoint, so only `last` needs
-    # to be addressed
-        sorted_items = reversed(sorted_items)
+    def fill(link, i):
+        # run in the thread pool, so no access to the (non thread-safe) tree
+        elapsed = time.time() - start_time
 
-    elif options.order in ['newest', 'oldest']:
-        now = datetime.now(tz.tzutc())
-        sorted_items = sorted(sorted_items, key=lambda x:x.updated or x.time or now) # oldest to newest
+        if elapsed > lim_time >= 0:
+            # hard cap
+            return None
 
-        if options.order == 'newest':
-            sorted_items = reversed(sorted_items)
+        # soft cap
+        fast = elapsed > max_time >= 0 or i + 1 > max_item >= 0
 
-    for i, item in enumerate(sorted_items):
-        # hard cap
-        if time.time() - start_time > lim_time >= 0 or i + 1 > lim_item >= 0:
-            log('dropped')
-            item.remove()
-            continue
+        deadline = start_time + lim_time if lim_time >= 0 else None
 
-        item = ItemBefore(item, options)
+        if options.proxy:
+            return fast, ItemResolve(link, options, fast)
 
-        if item is None:
-            continue
+        return fast, ItemFetch(link, options, fast, deadline)
 
-        item = ItemFix(item, options, url)
+    jobs = []
 
-        # soft cap
-        if time.time() - start_time > max_time >= 0 or i + 1 > max_item >= 0:
-            if not options.proxy:
-                if ItemFill(item, options, url, True) is False:
+    with ThreadPoolExecutor(max_workers=max(THREADS, 1)) as pool:
+        for i, item in enumerate(sorted_items):
+            # hard cap
+            if time.time() - start_time > lim_time >= 0 or i + 1 > lim_item >= 0:
+                log('dropped')
+                item.remove()
+                continue
+
+            item = ItemBefore(item, options)
+
+            if item is None:
+                continue
+
+            item = ItemFix(item, options, url)
+
+            if (options.proxy and not options.resolve) or not item.link:
+                jobs.append((item, None))
+
+            else:
+                jobs.append((item, pool.submit(fill, item.link, i)))
+
+        # apply the results in the original order
+        for item, job in jobs:
+            if job is not None:
+                result = job.result()
+
+                if result is None:
+                    log('dropped')
                     item.remove()
                     continue
 
-        else:
-            if not options.proxy:
-                ItemFill(item, options, url)
+                fast, fetched = result
+
+                if ItemUpdate(item, options, fetched) is False and fast:
+                    item.remove()
+                    continue
 
-        item = ItemAfter(item, options)
+            item = ItemAfter(item, options)
 
     if options.ad:
         new = rss.items.append()
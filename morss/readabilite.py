@@ -380,6 +380,31 @@ def get_article(data, url=None, encoding_in=None, encoding_out='unicode', debug=
     return lxml.etree.tostring(best if not debug else html, method='html', encoding=encoding_out)
 
 
+class ArticleWatcher:
+    """ To be fed the html page as it's being downloaded. Tells when an article
+    container (<article>, <main>) with enough text was fully received, i.e.
+    when the rest of the page (comments, footer, etc.) can be skipped """
+
+    def __init__(self, min_words=150):
+        self.min_words = min_words
+        self.parser = lxml.etree.HTMLPullParser(events=('end',), tag=('article', 'main'))
+
+    def feed(self, data):
+        " Returns True once the article is complete "
+
+        try:
+            self.parser.feed(data)
+
+            for (action, node) in self.parser.read_events():
+                if count_words(' '.join(node.itertext())) >= self.min_words:
+                    return True
+
+        except lxml.etree.LxmlError:
+            pass
+
+        return False
+
+
 if __name__ == '__main__':
     import sys
 
@@ -16,10 +16,13 @@
 # with this program. If not, see <https://www.gnu.org/licenses/>.
 
 import cgitb
+import json
 import mimetypes
 import os.path
 import re
 import sys
+import threading
+import time
 import wsgiref.handlers
 import wsgiref.simple_server
 import wsgiref.util
@@ -35,11 +38,15 @@ except ImportError:
 
 from . import caching, crawler, readabilite
 from .morss import (DELAY, TIMEOUT, FeedFetch, FeedFormat, FeedGather,
-                    MorssException, Options, log)
+                    FeedRefresh, MorssException, Options, log)
 from .util import data_path
 
 PORT = int(os.getenv('PORT', 8000))
 
+PREWARM = int(os.getenv('PREWARM', 0)) # number of popular feeds to keep fresh in the background
+PREWARM_BUDGET = float(os.getenv('PREWARM_BUDGET', 0.1)) # max share of the time spent on it
+PREWARM_DELAY = 60 # how often to look for feeds to refresh (in sec)
+
 
 def parse_options(options):
     """ Turns ['md=True'] into {'md':True} """
@@ -96,6 +103,87 @@ def cgi_parse_environ(environ):
     return (url, options)
 
 
+class Prewarmer:
+    """ Keeps track of the most requested feeds (url + options), to refresh them
+    (and their articles) in the background, right before their cache expires,
+    so that clients don't have to wait for it """
+
+    def __init__(self, size=PREWARM, budget=PREWARM_BUDGET, delay=PREWARM_DELAY):
+        self.size = size
+        self.budget = budget
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.hits = {} # (url, options) -> number of requests (decaying)
+
+    def hit(self, url, options):
+        key = (url, tuple(sorted(options.options.items())))
+
+        with self.lock:
+            if key not in self.hits and len(self.hits) >= 1000:
+                # too many feeds, forget about the least popular ones
+                for old in sorted(self.hits, key=self.hits.get)[:100]:
+                    del self.hits[old]
+
+            self.hits[key] = self.hits.get(key, 0) + 1
+
+    def due(self):
+        " Returns the hottest feeds whose cache expires before the next run "
+
+        with self.lock:
+            hottest = sorted(self.hits, key=self.hits.get, reverse=True)[:self.size]
+
+            # so that the popularity follows the traffic
+            for key in list(self.hits):
+                self.hits[key] //= 2
+
+                if not self.hits[key]:
+                    del self.hits[key]
+
+        for (url, options) in hottest:
+            entry = crawler.CacheHandler().load(crawler.sanitize_url(url))
+            lifespan = FeedRefresh(url)[0] # how long FeedFetch uses the cached copy
+
+            if entry is None or time.time() - entry['timestamp'] > lifespan - self.delay:
+                yield (url, Options(dict(options)))
+
+    def refresh(self, url, options):
+        forced = Options(dict(options.options, force=True))
+        feed_url, rss = FeedFetch(url, forced)
+
+        # now the articles, as usual (i.e. the new ones)
+        FeedGather(rss, feed_url, options)
+
+    def run(self):
+        spent = 0
+
+        for (url, options) in self.due():
+            if spent > self.budget * self.delay:
+                # leave the rest for later, not to compete with live traffic
+                break
+
+            start = time.time()
+
+            try:
+                self.refresh(url, options)
+
+            except Exception as e:
+                log('prewarm error: %s' % repr(e))
+
+            spent += time.time() - start
+
+    def autorun(self):
+        # run every so often
+
+        self.run()
+
+        t = threading.Timer(self.delay, self.autorun)
+        t.daemon = True
+        t.start()
+
+
+default_prewarmer = Prewarmer()
+
+
 def cgi_app(environ, start_response):
     url, options = cgi_parse_environ(environ)
 
@@ -126,7 +214,12 @@ def cgi_app(environ, start_response):
     headers['content-type'] += '; charset=utf-8'
 
     # get the work done
-    url, rss = FeedFetch(url, options)
+    feed_url, rss = FeedFetch(url, options)
+
+    if PREWARM:
+        default_prewarmer.hit(url, options)
+
+    url = feed_url
 
     start_response(headers['status'], list(headers.items()))
 
@@ -226,8 +319,24 @@ def cgi_get(environ, start_response):
     return [output]
 
 
+def cgi_stats(environ, start_response):
+    # what the crawler saw so far, to help tune the settings
+    if 'DEBUG' not in os.environ:
+        raise MorssException('stats only available in debug mode')
+
+    out = {
+        'latency': crawler.default_latency.stats(),
+        'dns': crawler.default_dns.stats(),
+        }
+
+    headers = {'status': '200 OK', 'content-type': 'application/json'}
+    start_response(headers['status'], list(headers.items()))
+    return [json.dumps(out, indent=4)]
+
+
 dispatch_table = {
     'get': cgi_get,
+    'stats': cgi_stats,
     }
 
 
@@ -289,6 +398,9 @@ class WSGIRequestHandlerRequestUri(wsgiref.simple_server.WSGIRequestHandler):
 def cgi_start_server():
     caching.default_cache.autotrim()
 
+    if PREWARM:
+        default_prewarmer.autorun()
+
     print('Serving http://localhost:%s/' % PORT)
     httpd = wsgiref.simple_server.make_server('', PORT, application, handler_class=WSGIRequestHandlerRequestUri)
     httpd.serve_forever()
@@ -296,3 +408,6 @@ def cgi_start_server():
 
 if 'gunicorn' in os.getenv('SERVER_SOFTWARE', ''):
     caching.default_cache.autotrim()
+
+    if PREWARM:
+        default_prewarmer.autorun()
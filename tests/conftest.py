@@ -35,6 +35,13 @@ class HTTPReplayHandler(SimpleHTTPRequestHandler):
         finally:
             f.close()
 
+    def do_HEAD(self):
+        # same as GET, without the body
+        path = self.translate_path(self.path)
+
+        with open(path, 'rb') as f:
+            self.wfile.write(f.read().split(b'\r\n\r\n')[0] + b'\r\n\r\n')
+
 class MuteHTTPServer(HTTPServer):
     def handle_error(self, request, client_address):
         # mute errors
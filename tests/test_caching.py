@@ -0,0 +1,39 @@
+import time
+
+from morss.caching import *
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000)
+    assert bloom.hashes == 7
+    assert len(bloom.data) < 1300
+
+    for i in range(1000):
+        bloom.add('http://example.com/%s' % i)
+
+    assert all('http://example.com/%s' % i in bloom for i in range(1000))
+    assert sum('http://example.org/%s' % i in bloom for i in range(1000)) < 30
+
+    other = BloomFilter(1000)
+    other.add('http://example.net/')
+    bloom.update(other.data)
+    assert 'http://example.net/' in bloom
+
+def test_aging_bloom_filter():
+    cache = CappedDict()
+
+    a = AgingBloomFilter(1000, 3600, cache, 'bloom')
+    b = AgingBloomFilter(1000, 3600, cache, 'bloom')
+
+    a.add('http://example.com/')
+    b.add('http://example.org/')
+    a.sync()
+    b.sync()
+    assert 'http://example.com/' in b
+    assert 'http://example.org/' in b
+
+    c = AgingBloomFilter(1000, 2)
+    c.add('http://example.com/')
+    assert 'http://example.com/' in c
+    time.sleep(2.1)
+    assert 'http://example.com/' not in c
@@ -1,6 +1,21 @@
+import os
+import pickle
+import socket
+import threading
+import time
+import zlib
+from http.client import HTTPConnection
+from io import BytesIO
+from urllib.error import HTTPError, URLError
+from urllib.request import BaseHandler, Request, build_opener
+
+import chardet
 import pytest
 
+from morss import crawler
+from morss.caching import CappedDict
 from morss.crawler import *
+from morss.readabilite import ArticleWatcher
 
 
 def test_get(replay_server):
@@ -9,6 +24,25 @@ def test_get(replay_server):
 def test_adv_get(replay_server):
     assert adv_get('http://localhost:8888/200-ok.txt')['data'] == b'success\r\n'
 
+def test_connection_pool():
+    class FakeConnection:
+        sock = True
+
+        def close(self):
+            self.sock = None
+
+    pool = ConnectionPool(size=1, idle=30)
+    conn1, conn2 = FakeConnection(), FakeConnection()
+
+    pool.release('key', conn1)
+    pool.release('key', conn2)
+    assert conn1.sock is None # over the per-host limit
+    assert pool.get('key') is conn2
+    assert pool.get('key') is None
+
+    pool.release('key', conn2, reusable=False)
+    assert pool.get('key') is None
+
 @pytest.mark.parametrize('before,after', [
     (b'http://localhost:8888/',     'http://localhost:8888/'),
     ('localhost:8888/',             'http://localhost:8888/'),
@@ -40,6 +74,59 @@ def test_encoding_fix_handler(replay_server, opener, url):
     out = out['data'].decode(out['encoding'])
     assert 'succes' in out or 'succès' in out or '成功' in out
 
+def test_charset_memo(replay_server, monkeypatch):
+    monkeypatch.setattr(crawler, 'charset_memo', CappedDict(size=10))
+    opener = build_opener(EncodingFixHandler())
+
+    # learnt from the declared charsets...
+    assert opener.open('http://localhost:8888/enc-gb2312-header.txt').encoding == 'gbk'
+    assert crawler.charset_memo['localhost'] == 'gb2312'
+
+    # ...and used for the other pages of the host, before chardet
+    def detect(data):
+        raise AssertionError('chardet used')
+
+    monkeypatch.setattr(chardet, 'detect', detect)
+    resp = opener.open('http://localhost:8888/enc-gb2312-missing.txt')
+    assert resp.encoding == 'gbk'
+    assert resp.text == '成功\n'
+
+def test_data_response_decode_once(monkeypatch):
+    calls = []
+
+    def detect(data, resp=None):
+        calls.append(data)
+        return 'utf-8'
+
+    monkeypatch.setattr(crawler, 'detect_encoding', detect)
+    resp = DataResponse('succès'.encode('utf-8'), parse_headers(), 'http://localhost/', 200)
+
+    assert resp.text == 'succès'
+    assert resp.text == 'succès'
+    assert resp.copy().encoding == 'utf-8'
+    assert len(calls) == 1
+
+    # new body, detected again (unless told)
+    resp.set_data(b'success')
+    assert resp.text == 'success'
+    assert len(calls) == 2
+
+    resp.set_data(b'\xe6\x88\x90', text='成', encoding='utf-8')
+    assert resp.text == '成'
+    assert len(calls) == 2
+
+def test_http_equiv_charset(replay_server, monkeypatch):
+    monkeypatch.setattr(crawler, 'charset_memo', CappedDict(size=10))
+    opener = build_opener(EncodingFixHandler(), HTTPEquivHandler())
+
+    # misleading guess from a previous page of the host
+    opener.open('http://localhost:8888/enc-gb2312-header.txt')
+
+    # the <meta> is past what declared_encoding looks at, it's found afterwards
+    resp = opener.open('http://localhost:8888/enc-iso-8859-1-http-equiv.txt')
+    assert resp.encoding == 'iso-8859-1'
+    assert 'succès' in resp.text
+
 @pytest.mark.parametrize('opener', [custom_opener(follow='rss'), build_opener(AlternateHandler(MIMETYPE['rss']))])
 def test_alternate_handler(replay_server, opener):
     assert opener.open('http://localhost:8888/alternate-abs.txt').geturl() == 'http://localhost:8888/200-ok.txt'
@@ -60,3 +147,612 @@ def test_http_all_redirect_handler(replay_server, opener):
 @pytest.mark.parametrize('opener', [custom_opener(), build_opener(HTTPRefreshHandler())])
 def test_http_refresh_handler(replay_server, opener):
     assert opener.open('http://localhost:8888/header-refresh.txt').geturl() == 'http://localhost:8888/200-ok.txt'
+
+def test_custom_opener_shared(replay_server):
+    assert custom_opener(policy='refresh') is custom_opener(policy='refresh')
+
+    adv_get('http://localhost:8888/200-ok.txt', policy='refresh')
+    hits = custom_opener.cache_info().hits
+    adv_get('http://localhost:8888/200-ok.txt', policy='refresh')
+    assert custom_opener.cache_info().hits == hits + 1
+
+def test_cookie_handler(replay_server):
+    class CookieRecorder(BaseHandler):
+        handler_order = 800 # once CookieHandler is done
+        cookies = []
+
+        def http_request(self, req):
+            CookieRecorder.cookies.append(req.get_header('Cookie'))
+            return req
+
+    opener = build_opener(CookieHandler(), HTTPAllRedirectHandler(), CookieRecorder())
+
+    # kept across the redirects...
+    assert opener.open('http://localhost:8888/302-cookie.txt').geturl() == 'http://localhost:8888/200-ok.txt'
+    assert CookieRecorder.cookies == [None, 'session=abc']
+
+    # ...but not sent along with the other fetches
+    opener.open('http://localhost:8888/200-ok.txt')
+    assert CookieRecorder.cookies == [None, 'session=abc', None]
+
+def test_cache_handler_single_load(replay_server):
+    class CountingCache(CappedDict):
+        hits = 0
+
+        def __getitem__(self, key):
+            if not key.startswith(CACHE_BODY):
+                self.hits += 1
+            return CappedDict.__getitem__(self, key)
+
+    cache = CountingCache()
+    opener = build_opener(CacheHandler(cache=cache, force_min=60))
+
+    for i in range(2):
+        cache.hits = 0
+        assert opener.open('http://localhost:8888/200-ok.txt').read() == b'success\r\n'
+        assert cache.hits == 1
+
+def test_cache_handler_entry_format():
+    cache = CappedDict()
+    handler = CacheHandler(cache=cache)
+
+    # entries from older versions are migrated on load
+    cache['http://old/'] = pickle.dumps({'code': 200, 'msg': 'OK', 'headers': 'ETag: "abc"\n\n', 'data': b'success', 'timestamp': 1.0}, 0)
+    assert handler.load('http://old/')['headers']['etag'] == '"abc"'
+    assert cache['http://old/'].startswith(CACHE_MAGIC)
+
+    entry = handler.load('http://old/')
+    assert (entry['code'], entry['msg'], entry['data'], entry['timestamp']) == (200, 'OK', b'success', 1.0)
+    assert entry['headers']['etag'] == '"abc"'
+
+    cache['http://v1/'] = CACHE_ENTRY_V1.pack(b'mrs\x01', 1.0, 200, 2, 0) + b'OKsuccess'
+    assert handler.load('http://v1/')['data'] == b'success'
+    assert cache['http://v1/'].startswith(CACHE_MAGIC)
+
+    # body kept apart, only loaded when needed
+    assert b'success' not in cache['http://old/']
+    assert cache[CACHE_BODY + 'http://old/'] == b'success'
+
+    entry = handler.load('http://old/')
+    assert 'data' not in entry
+    cache[CACHE_BODY + 'http://old/'] = b'other page'
+
+    with pytest.raises(KeyError):
+        entry['data']
+
+def test_cache_handler_body_gone(replay_server):
+    url = 'http://localhost:8888/200-ok.txt'
+    cache = CappedDict()
+    opener = build_opener(CacheHandler(cache=cache, force_min=60))
+
+    assert opener.open(url).read() == b'success\r\n'
+    del cache[CACHE_BODY + url]
+    assert opener.open(url).read() == b'success\r\n'
+    assert cache[CACHE_BODY + url] == b'success\r\n'
+
+def test_cache_handler_stale_if_error(replay_server):
+    url = 'http://localhost:8888/missing.txt' # server drops the connection
+    entry = {'code': 200, 'msg': 'OK', 'headers': parse_headers(), 'data': b'stale', 'timestamp': time.time() - 3600}
+
+    CacheHandler().save(url, entry)
+    assert adv_get(url)['data'] == b'stale'
+
+    entry['timestamp'] = time.time() - 30*24*3600
+    CacheHandler().save(url, entry)
+
+    with pytest.raises(IOError):
+        adv_get(url)
+
+    # failed lookup, the cached page is still there
+    assert CacheHandler().load(url)['data'] == b'stale'
+
+def test_cache_handler_freshness():
+    from email.utils import formatdate
+
+    handler = CacheHandler()
+    now = time.time()
+
+    def entry(headers, age=0, code=200):
+        text = ''.join('%s: %s\n' % x for x in headers.items()) + '\n'
+        return {'code': code, 'headers': parse_headers(text), 'timestamp': now - age}
+
+    assert handler.lifetime(entry({})) == 0
+    assert handler.lifetime(entry({'Cache-Control': 'max-age=60'})) == 60
+    assert handler.lifetime(entry({'Cache-Control': 'max-age=60, no-cache'})) == 0
+    assert handler.lifetime(entry({'Date': formatdate(now), 'Expires': formatdate(now + 60)})) == 60
+    assert handler.lifetime(entry({'Expires': '0'})) == 0
+
+    # heuristic: 10% of the time since last modified, capped
+    assert handler.lifetime(entry({'Date': formatdate(now), 'Last-Modified': formatdate(now - 1000)})) == 100
+    assert handler.lifetime(entry({'Date': formatdate(now), 'Last-Modified': formatdate(now - 1000)}, code=500)) == 0
+    assert handler.lifetime(entry({'Date': formatdate(now), 'Last-Modified': formatdate(now - 365*24*3600)})) == 24*3600
+
+    # time spent in upstream caches
+    assert 99 < handler.age(entry({'Age': '100'})) < 101
+    assert 109 < handler.age(entry({'Age': '100', 'Date': formatdate(now - 110)}, age=0)) < 111
+
+def test_cache_handler_heuristic(replay_server):
+    url = 'http://localhost:8888/missing.txt' # server drops the connection
+    cache = CappedDict()
+    opener = build_opener(CacheHandler(cache=cache))
+
+    entry = {'code': 200, 'msg': 'OK', 'data': b'cached', 'timestamp': time.time() - 60,
+        'headers': parse_headers('Last-Modified: Mon, 01 Jan 2018 00:00:00 GMT\n\n')}
+    CacheHandler(cache=cache).save(url, entry)
+
+    # not modified for long, so served without even asking the server
+    assert opener.open(url).read() == b'cached'
+
+def test_fetch_scheduler():
+    scheduler = FetchScheduler(total=1, per_host=1, delay=0)
+    order = []
+
+    def fetch(priority):
+        scheduler.acquire('b', priority)
+        order.append(priority)
+        scheduler.release('b')
+
+    scheduler.acquire('a')
+
+    with pytest.raises(URLError):
+        # global cap reached
+        scheduler.acquire('b', timeout=0.1)
+
+    threads = [threading.Thread(target=fetch, args=(x,)) for x in (2, 1, 0)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.1)
+
+    scheduler.release('a')
+    for thread in threads:
+        thread.join()
+
+    assert order == [0, 1, 2]
+
+    # min interval between fetches to the same host
+    scheduler = FetchScheduler(per_host=2, delay=0.2)
+    scheduler.acquire('a')
+    start = time.time()
+    scheduler.acquire('a')
+    assert time.time() - start >= 0.15
+
+def test_keep_alive_retry(replay_server):
+    from http.client import HTTPConnection, RemoteDisconnected
+
+    class ClosedConnection:
+        " Reused connection, closed by the server once the request is sent "
+
+        sock = socket.socket()
+        requests = 0
+
+        def set_debuglevel(self, level):
+            pass
+
+        def request(self, *args, **kwargs):
+            ClosedConnection.requests += 1
+
+        def getresponse(self):
+            raise RemoteDisconnected()
+
+        def close(self):
+            pass
+
+    class Handler(HTTPKeepAliveHandler):
+        pool = ConnectionPool(size=1, idle=30)
+        breaker = CircuitBreaker()
+        latency_tracker = LatencyTracker()
+
+    opener = build_opener(Handler())
+
+    # GET: tried again on a fresh connection
+    Handler.pool.release((HTTPConnection, 'localhost:8888'), ClosedConnection())
+    assert opener.open('http://localhost:8888/200-ok.txt').read() == b'success\r\n'
+
+    # POST: not sent twice
+    Handler.pool.release((HTTPConnection, 'localhost:8888'), ClosedConnection())
+
+    with pytest.raises(RemoteDisconnected):
+        opener.open('http://localhost:8888/200-ok.txt', data=b'post')
+
+    assert ClosedConnection.requests == 2
+
+def test_keep_alive_timeouts():
+    class Handler(HTTPKeepAliveHandler):
+        breaker = CircuitBreaker()
+        latency_tracker = LatencyTracker()
+
+        def do_pooled_open(self, http_class, req, **http_conn_args):
+            raise URLError(socket.timeout('timed out'))
+
+    opener = build_opener(Handler())
+
+    # timeout cut short by the caller's deadline, the host isn't to blame
+    req = Request('http://localhost:8888/')
+    req.clamped = True
+
+    with pytest.raises(URLError):
+        opener.open(req, timeout=0.1)
+
+    assert Handler.breaker.hosts == {}
+    assert Handler.latency_tracker.hosts == {}
+
+    # slow host
+    with pytest.raises(URLError):
+        opener.open('http://localhost:8888/', timeout=0.1)
+
+    assert Handler.breaker.hosts['localhost:8888']['failures'] == 1
+    assert len(Handler.latency_tracker.hosts['localhost:8888']) == 1
+
+def test_keep_alive_not_pooled():
+    class Handler(HTTPKeepAliveHandler):
+        scheduler = FetchScheduler(total=1, per_host=1, delay=0)
+        breaker = CircuitBreaker()
+        latency_tracker = LatencyTracker()
+
+        def do_pooled_open(self, http_class, req, **http_conn_args):
+            # e.g. https via a proxy
+            return DataResponse(b'success', parse_headers(), req.get_full_url(), 200, 'OK')
+
+    opener = build_opener(Handler())
+
+    for i in range(2):
+        # slot freed straight away, or the 2nd one would time out
+        assert opener.open('http://localhost:8888/', timeout=1).read() == b'success'
+
+def test_keep_alive_stalled_body():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    server.settimeout(0.1)
+    clients = []
+    running = True
+
+    def serve():
+        # sends the headers and part of the body, then stalls
+        while running:
+            try:
+                client = server.accept()[0]
+
+            except socket.timeout:
+                continue
+
+            client.recv(4096)
+            client.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nabc')
+            clients.append(client)
+
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    class Handler(HTTPKeepAliveHandler):
+        pool = ConnectionPool(size=1, idle=30)
+        scheduler = FetchScheduler(per_host=1, delay=0)
+        breaker = CircuitBreaker()
+        latency_tracker = LatencyTracker()
+
+    opener = build_opener(Handler())
+    url = 'http://127.0.0.1:%s/' % server.getsockname()[1]
+
+    try:
+        for read in (buffer_response, lambda resp: watch_response(resp, None)) * 2:
+            # would time out waiting for a fetch slot if the previous one was kept
+            resp = opener.open(url, timeout=0.2)
+
+            with pytest.raises(socket.timeout):
+                read(resp)
+
+            assert Handler.scheduler.running == {}
+
+    finally:
+        running = False
+        thread.join()
+        server.close()
+
+        for client in clients:
+            client.close()
+
+def test_in_flight():
+    flights = InFlight()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'result'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do('key', slow))) for i in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(results) == [('result', False)] * 4 + [('result', True)]
+    assert flights.do('key', slow) == ('result', True)
+
+    # followers don't wait for longer than they're allowed to
+    thread = threading.Thread(target=flights.do, args=('key', slow))
+    thread.start()
+    time.sleep(0.05)
+
+    start = time.time()
+    with pytest.raises(URLError):
+        flights.do('key', slow, timeout=0.05)
+
+    assert time.time() - start < 0.15
+    thread.join()
+
+def test_hedger():
+    latency = LatencyTracker()
+    for i in range(10):
+        latency.add('host', 0.05)
+
+    hedger = Hedger(percent=100, latency=latency)
+    delays = []
+
+    def slow_then_fast():
+        hedger.went_online()
+        delay = delays.pop(0)
+        time.sleep(delay)
+        return delay
+
+    # cache hits, or unknown hosts (never hedged): not counted
+    for i in range(3):
+        assert hedger.do('host', lambda: 'cached') == 'cached'
+
+    delays = [0.2, 0]
+    assert hedger.do('other', slow_then_fast) == 0.2
+    assert hedger.budget == 0
+
+    # budget: one extra call per call, so 1st call not hedged, 2nd is
+    delays = [0.2]
+    assert hedger.do('host', slow_then_fast) == 0.2
+
+    delays = [1, 0]
+    start = time.time()
+    assert hedger.do('host', slow_then_fast) == 0
+    assert time.time() - start < 0.5
+
+def test_adv_get_shared(replay_server):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(adv_get('http://localhost:8888/200-ok.txt', policy='refresh'))) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [x['con'].read() for x in results] == [b'success\r\n'] * 3
+
+def test_dns_cache(replay_server):
+    dns = DNSCache()
+
+    dns.create_connection(('localhost', 8888)).close()
+    dns.create_connection(('localhost', 8888)).close()
+    assert (dns.hits, dns.misses) == (1, 1)
+
+    for i in range(2):
+        with pytest.raises(socket.gaierror):
+            dns.getaddrinfo('morss.invalid', 80)
+
+    assert dns.stats() == {'hits': 2, 'misses': 2, 'size': 2}
+
+    # one lookup per host, in the background
+    dns = DNSCache(workers=2)
+    dns.prefetch(['http://localhost:8888/a', 'http://localhost:8888/b', 'https://localhost/', 'ftp://localhost/'])
+    dns.executor.shutdown(wait=True)
+    assert dns.stats() == {'hits': 0, 'misses': 2, 'size': 2}
+    assert not dns.pending
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failures=2, delay=0.2)
+
+    breaker.failure('a')
+    breaker.check('a')
+    breaker.failure('a')
+
+    with pytest.raises(CircuitOpen):
+        breaker.check('a')
+
+    time.sleep(0.25)
+    breaker.check('a') # probe
+
+    with pytest.raises(CircuitOpen):
+        # only one probe at once
+        breaker.check('a')
+
+    breaker.success('a')
+    breaker.check('a')
+
+    breaker.failure('b', retry_after='120')
+    assert 115 < breaker.hosts['b']['until'] - time.time() <= 120
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+
+def test_gzip_limit():
+    bomb = zlib.compress(b'\0' * 10*1024**2)
+    assert len(UnDeflate(bomb, 1024)) == 1024
+    assert len(UnDeflate(bomb[2:-4], 1024)) == 1024 # raw deflate
+    assert UnDeflate(bomb) == b'\0' * 10*1024**2
+
+    gzip_bomb = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    gzip_bomb = gzip_bomb.compress(b'\0' * 10*1024**2) + gzip_bomb.flush()
+    assert len(UnGzip(gzip_bomb, 1024)) == 1024
+
+def test_content_type_handler(replay_server):
+    cache = CappedDict()
+    opener = build_opener(ContentTypeHandler(['text/html']), CacheHandler(cache=cache))
+
+    assert opener.open('http://localhost:8888/200-ok.txt').read() == b''
+    assert len(cache) == 0
+
+    assert adv_get('http://localhost:8888/200-ok.txt', accept=['text/plain'])['data'] == b'success\r\n'
+
+def test_record_replay(replay_server, tmp_path):
+    folder = str(tmp_path)
+
+    opener = build_opener(RecordHandler(folder))
+    assert opener.open('http://localhost:8888/301-redirect-abs.txt').read() == b'success\r\n'
+    assert len(os.listdir(folder)) == 4 # redirect + page, .txt and .json each
+
+    opener = build_opener(HTTPReplayHandler(folder, latency=1))
+    resp = opener.open('http://localhost:8888/301-redirect-abs.txt')
+    assert resp.geturl() == 'http://localhost:8888/200-ok.txt'
+    assert resp.read() == b'success\r\n'
+
+    with pytest.raises(HTTPError):
+        opener.open('http://localhost:8888/200-ok.txt?missing')
+
+def test_resolve_replay(replay_server, tmp_path, monkeypatch):
+    monkeypatch.setattr('morss.crawler.REPLAY', str(tmp_path))
+    resolve_opener.cache_clear()
+
+    try:
+        assert [type(x) for x in transport_handlers()] == [HTTPReplayHandler, HTTPSReplayHandler]
+
+        # not recorded, so not found, rather than fetched online
+        url = 'http://localhost:8888/308-redirect.txt?replay'
+        assert resolve_url(url) == url
+
+    finally:
+        resolve_opener.cache_clear()
+
+def test_watch_response(replay_server):
+    class Watcher:
+        def feed(self, data):
+            return True
+
+    cache = CappedDict()
+    opener = build_opener(SizeLimitHandler(), CacheHandler(cache=cache, force_min=60))
+
+    req = Request('http://localhost:8888/size-1MiB.txt')
+    req.watcher = Watcher
+    resp = opener.open(req)
+    assert len(resp.read()) == 16*1024
+    assert resp.headers['x-morss-partial'] == '1'
+
+    # the partial copy is good enough for the next fetches with a watcher...
+    req = Request('http://localhost:8888/size-1MiB.txt')
+    req.watcher = Watcher
+    resp = opener.open(req)
+    assert req.from_morss_cache
+    assert len(resp.read()) == 16*1024
+
+    # ...but not for the others
+    resp = opener.open('http://localhost:8888/size-1MiB.txt')
+    assert len(resp.read()) == 1024**2
+    assert 'x-morss-partial' not in resp.headers
+
+@pytest.mark.parametrize('url,partial', [
+    ('http://localhost:8888/article-tag-utf-8.txt', True),
+    ('http://localhost:8888/article-notag-utf-8.txt', False),
+])
+def test_watch_response_article(replay_server, url, partial):
+    req = Request(url)
+    req.watcher = ArticleWatcher
+    resp = build_opener(SizeLimitHandler()).open(req)
+    data = resp.read()
+
+    assert data.startswith(b'<html>')
+    assert ('x-morss-partial' in resp.headers) == partial
+    assert (len(data) < 32*1024) == partial
+
+def test_watch_response_unzip_limit():
+    class Watcher:
+        fed = 0
+
+        def feed(self, data):
+            Watcher.fed += len(data)
+            return False
+
+    bomb = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    data = bomb.compress(b'\0' * 10*1024**2) + bomb.flush()
+
+    resp = addinfourl(BytesIO(data), parse_headers('Content-Encoding: gzip\r\n\r\n'), 'http://localhost/', 200)
+    resp.msg = 'OK'
+    out = watch_response(resp, Watcher(), unzip_limit=1024**2)
+
+    assert out.data == data
+    assert Watcher.fed == 1024**2
+
+def test_latency_tracker():
+    latency = LatencyTracker(factor=2, low=1, high=10)
+    assert latency.timeout('a', 4) == 4
+
+    for i in range(10):
+        latency.add('a', 0.1)
+        latency.add('b', 3)
+        latency.add('c', 100)
+
+    assert latency.timeout('a', 4) == 1
+    assert latency.timeout('b', 4) == 6
+    assert latency.timeout('c', 4) == 10
+    assert latency.stats()['b']['p50'] == 3
+
+def test_adv_get_deadline(replay_server):
+    with pytest.raises(URLError):
+        adv_get('http://localhost:8888/200-ok.txt?late', deadline=time.time() - 1)
+
+def test_redirect_map(replay_server):
+    redirects = RedirectMap(cache=CappedDict(), permanent=60, temporary=0)
+    redirects.add([('http://a/', 301, False), ('http://b/', 301, False), ('http://c/', 302, True), ('http://d/', 301, False)], 'http://e/')
+
+    assert redirects.get('http://a/') == 'http://c/'
+    assert redirects.get('http://b/') == 'http://c/'
+    assert redirects.get('http://c/') is None # synthetic
+    assert redirects.get('http://d/') == 'http://e/'
+
+    redirects.add([('http://f/', 302, False), ('http://g/', 301, False)], 'http://h/')
+    assert redirects.get('http://f/') is None # temporary, expired
+    assert redirects.get('http://g/') == 'http://h/'
+
+    url = 'http://localhost:8888/301-redirect-abs.txt'
+    assert adv_get(url)['url'] == 'http://localhost:8888/200-ok.txt'
+    assert default_redirects.get(url) == 'http://localhost:8888/200-ok.txt'
+    assert adv_get(url)['data'] == b'success\r\n'
+
+    # not in cache, but the redirect still stands
+    (src, dst) = ('http://localhost:8888/offline-src', 'http://localhost:8888/offline-dst')
+    default_redirects.set(src, dst, True)
+
+    with pytest.raises(HTTPError):
+        adv_get(src, policy='offline')
+
+    assert default_redirects.get(src) == dst
+
+def test_discovery_index(replay_server):
+    url = 'http://localhost:8888/alternate-abs.txt'
+    assert adv_get(url, follow='rss')['url'] == 'http://localhost:8888/200-ok.txt'
+    assert default_discovery.get(url, MIMETYPE['rss']) == 'http://localhost:8888/200-ok.txt'
+    assert default_discovery.get(url, MIMETYPE['json']) is None
+
+    assert adv_get(url, follow='rss')['data'] == b'success\r\n'
+    assert adv_get(url)['url'] == url # not when not following
+
+    # not in cache, but the page still points to the feed
+    (page, feed) = ('http://localhost:8888/offline-page', 'http://localhost:8888/offline-feed')
+    default_discovery.add(page, feed, MIMETYPE['rss'][0])
+
+    with pytest.raises(HTTPError):
+        adv_get(page, follow='rss', policy='offline')
+
+    assert default_discovery.get(page, MIMETYPE['rss']) == feed
+
+def test_resolve_url(replay_server):
+    url = 'http://localhost:8888/308-redirect.txt'
+    assert resolve_url(url, offline=True) == url
+    assert resolve_url(url) == 'http://localhost:8888/200-ok.txt'
+    assert resolve_url(url, offline=True) == 'http://localhost:8888/200-ok.txt'
+
+    url = 'http://localhost:8888/200-ok.txt?resolve'
+    assert resolve_url(url) == url
+    assert default_redirects.get(url) == url
+
+    # connection kept for the next ones
+    default_pool.conns.pop((HTTPConnection, 'localhost:8888'), None)
+    url = 'http://localhost:8888/200-ok.txt?pooled'
+    assert resolve_url(url) == url
+    assert len(default_pool.conns[(HTTPConnection, 'localhost:8888')]) == 1
+
+    # server error, to be tried again
+    url = 'http://localhost:8888/503-unavailable.txt'
+    assert resolve_url(url) == url
+    assert default_redirects.get(url) is None
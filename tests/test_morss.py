@@ -0,0 +1,96 @@
+import json
+import time
+
+import pytest
+
+from morss import caching
+from morss.crawler import adv_get
+from morss.feeds import parse
+from morss.morss import *
+
+
+def test_feed_gather(replay_server, monkeypatch):
+    monkeypatch.setattr('morss.morss.MAX_ITEM', 3) # cache-only beyond
+    monkeypatch.setattr('morss.morss.LIM_ITEM', 4) # deleted beyond
+    monkeypatch.setattr('morss.morss.MAX_TIME', -1)
+    monkeypatch.setattr('morss.morss.LIM_TIME', -1)
+
+    url = 'http://localhost:8888/feed-articles-utf-8.txt'
+
+    def gather():
+        out = adv_get(url)
+        rss = parse(out['data'], url=url, encoding=out['encoding'])
+        return list(FeedGather(rss, url, Options()).items)
+
+    items = gather()
+
+    # 4th one not in cache so deleted, 5th one beyond the limit
+    assert [x.title for x in items] == ['!ITEM_TITLE_0!', '!ITEM_TITLE_1!', '!ITEM_TITLE_2!']
+
+    # each item got its own article (none for a non-article page)
+    assert '!ARTICLE_CONTENT!' in items[0].content
+    assert '!ARTICLE_CONTENT!' not in (items[1].content or '')
+    assert '!ARTICLE_CONTENT!' in items[2].content
+
+    # cache-only, i.e. kept once in cache
+    adv_get('http://localhost:8888/article-utf-8.txt?3')
+    items = gather()
+    assert len(items) == 4
+    assert '!ARTICLE_CONTENT!' in items[3].content
+
+    # out of time, all deleted
+    monkeypatch.setattr('morss.morss.LIM_TIME', 0)
+    assert gather() == []
+
+@pytest.fixture
+def history(monkeypatch):
+    monkeypatch.setattr('morss.caching.default_cache', caching.CappedDict())
+    monkeypatch.setattr('morss.morss.REFRESH_MIN', 300)
+    monkeypatch.setattr('morss.morss.REFRESH_MAX', 3600)
+
+    def set_history(url, updates):
+        caching.default_cache['history:' + url] = json.dumps({'ids': [], 'updates': updates}).encode('utf-8')
+
+    return set_history
+
+def test_feed_refresh(history):
+    now = time.time()
+
+    # nothing known
+    assert FeedRefresh('http://feed/') == (300, 3600)
+
+    history('http://feed/', [now])
+    assert FeedRefresh('http://feed/') == (300, 3600)
+
+    # half the usual (median) gap
+    history('http://feed/', [now - 3100, now - 2100, now - 1100, now - 600, now - 100])
+    assert FeedRefresh('http://feed/') == (500, 500)
+
+    # unless it's been quiet for longer than that
+    history('http://feed/', [now - 5000, now - 4900, now - 4800])
+    assert FeedRefresh('http://feed/') == (2400, 2400)
+
+    # within bounds
+    history('http://feed/', [now - 20, now - 10, now])
+    assert FeedRefresh('http://feed/') == (300, 300)
+
+    history('http://feed/', [now - 40000, now - 20000, now])
+    assert FeedRefresh('http://feed/') == (3600, 3600)
+
+def test_feed_track(history):
+    def make_feed(*items):
+        return parse(('<rss version="2.0"><channel>%s</channel></rss>' % ''.join(
+            '<item><link>http://feed/%s</link><pubDate>%s</pubDate></item>' % x for x in items)).encode('utf-8'))
+
+    # first time, from the items' dates
+    FeedTrack('http://feed/', make_feed((1, 'Mon, 01 Jan 2022 02:00:00 +0000'), (2, 'Mon, 01 Jan 2022 01:00:00 +0000')))
+    assert FeedHistory('http://feed/')['updates'] == [1640998800, 1641002400]
+
+    # nothing new
+    FeedTrack('http://feed/', make_feed((1, 'Mon, 01 Jan 2022 02:00:00 +0000')))
+    assert len(FeedHistory('http://feed/')['updates']) == 2
+
+    # new item
+    FeedTrack('http://feed/', make_feed((3, 'Mon, 01 Jan 2022 03:00:00 +0000'), (1, 'Mon, 01 Jan 2022 02:00:00 +0000')))
+    updates = FeedHistory('http://feed/')['updates']
+    assert len(updates) == 3 and time.time() - updates[-1] < 5
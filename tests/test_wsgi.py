@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from morss.morss import Options
+from morss.wsgi import *
+
+
+@pytest.fixture
+def cache_entries(monkeypatch):
+    entries = {} # url -> cache entry
+
+    class FakeCacheHandler:
+        def load(self, url):
+            return entries.get(url)
+
+    monkeypatch.setattr('morss.wsgi.crawler.CacheHandler', FakeCacheHandler)
+    monkeypatch.setattr('morss.wsgi.FeedRefresh', lambda url: (600, 600))
+
+    return entries
+
+def test_prewarmer_hits(cache_entries):
+    prewarmer = Prewarmer(size=1, delay=60)
+
+    for i in range(3):
+        prewarmer.hit('http://a/', Options())
+    prewarmer.hit('http://b/', Options({'clip': True}))
+
+    # only the hottest one
+    assert [url for (url, options) in prewarmer.due()] == ['http://a/']
+
+    # popularity halved on every run
+    assert prewarmer.hits == {('http://a/', ()): 1}
+
+def test_prewarmer_due(cache_entries):
+    prewarmer = Prewarmer(size=10, delay=60)
+
+    for url in ('http://missing/', 'http://fresh/', 'http://expiring/'):
+        prewarmer.hit(url, Options({'clip': True}))
+
+    cache_entries['http://fresh/'] = {'timestamp': time.time()}
+    cache_entries['http://expiring/'] = {'timestamp': time.time() - 550} # i.e. before the next run
+
+    due = dict(prewarmer.due())
+    assert sorted(due) == ['http://expiring/', 'http://missing/']
+    assert due['http://missing/'].clip is True
+
+def test_prewarmer_budget(cache_entries):
+    prewarmer = Prewarmer(size=10, budget=0.1, delay=1)
+    refreshed = []
+
+    def refresh(url, options):
+        refreshed.append(url)
+        time.sleep(0.15)
+
+    prewarmer.refresh = refresh
+
+    for url in ('http://a/', 'http://b/', 'http://c/'):
+        prewarmer.hit(url, Options())
+
+    # 0.1s budget, spent after the 1st one
+    prewarmer.run()
+    assert len(refreshed) == 1